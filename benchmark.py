@@ -0,0 +1,177 @@
+# Copyright (c) 2014-2015, The Monero Project
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be
+#    used to endorse or promote products derived from this software without specific
+#    prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''Micro-benchmarks for the slownacl primitives and the dnscrypt encode and
+decode paths. Runs offline and writes its results as JSON:
+
+    python benchmark.py [-o results.json] [--backend NAME] [--sizes 64,1024]
+'''
+
+import argparse
+import json
+import os
+import platform
+import struct
+import time
+import timeit
+
+import dnscrypt
+import ed25519py
+from slownacl import salsa20, poly1305, curve25519
+
+DEFAULT_SIZES = [64, 512, 1024, 4096]
+MIN_TIME = 0.2  # seconds per measurement
+
+
+def measure(func, repeat=3):
+    '''Return the best time per call, in seconds.'''
+    number = 1
+    while timeit.timeit(func, number=number) < MIN_TIME / 10:
+        number *= 2
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def result(name, backend, size, seconds):
+    return {'name': name, 'backend': backend, 'size': size, 'seconds': seconds}
+
+
+def bench_slownacl(sizes):
+    results = []
+    n24, n8, k = os.urandom(24), os.urandom(8), os.urandom(32)
+    use_numpy = salsa20.USE_NUMPY
+    modes = [('slownacl', False)]
+    if salsa20.numpy is not None:
+        modes.append(('slownacl-numpy', True))
+    for (label, numpy) in modes:
+        salsa20.USE_NUMPY = numpy
+        for size in sizes:
+            results.append(result('stream_xsalsa20', label, size,
+                                  measure(lambda: salsa20.stream_xsalsa20(size, n24, k))))
+    salsa20.USE_NUMPY = use_numpy
+
+    for size in sizes:
+        m = os.urandom(size)
+        results.append(result('onetimeauth_poly1305', 'slownacl', size,
+                              measure(lambda: poly1305.onetimeauth_poly1305(m, k))))
+
+    p = curve25519.smult_curve25519_base(os.urandom(32))
+    curve25519.smult_curve25519_base(k)  # builds the base table outside the timing
+    results.append(result('smult_curve25519', 'slownacl', 32,
+                          measure(lambda: curve25519.smult_curve25519(k, p))))
+    results.append(result('smult_curve25519_base', 'slownacl', 32,
+                          measure(lambda: curve25519.smult_curve25519_base(k))))
+    return results
+
+
+def bench_backend(name, sizes):
+    dnscrypt.set_backend(name)
+    backend = dnscrypt.backend
+    results = []
+
+    (vk, sk) = ed25519py.crypto_sign_keypair()
+    bincert = ed25519py.crypto_sign(os.urandom(52), sk)
+
+    def verify():
+        ed25519py.verified.clear()
+        backend.sign_open(bincert, vk)
+    results.append(result('ed25519_verify', name, len(bincert), measure(verify)))
+
+    (pk, sk) = dnscrypt.generate_keypair()
+    (server_pk, server_sk) = dnscrypt.generate_keypair()
+    results.append(result('create_nmkey', name, 32,
+                          measure(lambda: dnscrypt.create_nmkey(server_pk, sk))))
+
+    nmkey = dnscrypt.create_nmkey(server_pk, sk)
+    nonce = dnscrypt.make_nonce()
+    for size in sizes:
+        message = os.urandom(size)
+        results.append(result('encode_message', name, size,
+                              measure(lambda: dnscrypt.encode_message(message, nonce, nmkey))))
+        encoded = dnscrypt.encode_message(message, nonce, nmkey)
+        results.append(result('decode_message', name, size,
+                              measure(lambda: dnscrypt.decode_message(encoded, nonce + 12 * '\x00', nmkey))))
+    return results
+
+
+def openalias_response(records):
+    '''A response to donate.getmonero.org TXT holding records OpenAlias entries.'''
+    question = dnscrypt.build_query('donate.getmonero.org', 16)[12:-12]
+    text = ('oa1:xmr recipient_address=46BeWrHpwXmHDpDEUmZBWZfoQpdc6HaERCNmx1pEYL2rAcuwufPN9rXHHt'
+            'yUA4QVy66qeFQkn6sfK8aHYjA3jk3o1Bv16em; recipient_name=Monero Development;')
+    rdata = chr(len(text)) + text
+    answer = '\xc0\x0c' + struct.pack('!HHIH', 16, 1, 300, len(rdata)) + rdata
+    header = struct.pack('!HHHHHH', 0x1234, 0x8180, 1, records, 0, 0)
+    return header + question + answer * records
+
+
+def bench_parser():
+    results = []
+    converter = dnscrypt.DnsPacketConverter()
+    for records in [1, 4, 16]:
+        response = openalias_response(records)
+        results.append(result('DnsPacketConverter.fromBinary', 'python', len(response),
+                              measure(lambda: converter.fromBinary(response))))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dnscrypt and slownacl.')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file')
+    parser.add_argument('--backend', action='append',
+                        help='crypto backend to measure, may be repeated (default: all available)')
+    parser.add_argument('--sizes', help='comma separated message sizes in bytes')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')] if args.sizes else DEFAULT_SIZES
+    backends = args.backend or dnscrypt.available_backends()
+    active = dnscrypt.backend_name()
+
+    results = bench_slownacl(sizes)
+    for name in backends:
+        results.extend(bench_backend(name, sizes))
+    dnscrypt.set_backend(active)
+    results.extend(bench_parser())
+
+    report = {
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'backends': backends,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
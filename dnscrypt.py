@@ -27,16 +27,31 @@
 # THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import socket
+import select
 import struct
-import StringIO
+import Queue
 import time
 import datetime
 import os
 import re
+import random
+import threading
+import warnings
+import collections
+import itertools
+import array
+import sqlite3
+import math
 from slownacl import poly1305, xsalsa20poly1305
 
 USE_LOCAL_LIBS = 1
 
+HEADER_STRUCT = struct.Struct('!HHHHHH')
+ID_STRUCT = struct.Struct('!H')
+QUESTION_STRUCT = struct.Struct('!HH')
+RECORD_STRUCT = struct.Struct('!HHiH')  # type, class, ttl, rdlength
+NONCE_STRUCT = struct.Struct('!II')  # timestamp, counter
+
 # OCTET 1,2     ID
 # OCTET 3,4 QR(1 bit) + OPCODE(4 bit)+ AA(1 bit) + TC(1 bit) + RD(1 bit)+ RA(1 bit) +
 #       Z(3 bit) + RCODE(4 bit)
@@ -64,27 +79,116 @@ class DnsHeader:
             self.nsCount,
             self.arCount)
 
-    def fromBinary(self, bin):
-        if bin.read:
-            bin = bin.read(12)
+    def fromBinary(self, bin, offset=0):
         (self.id,
          self.bits,
          self.qdCount,
          self.anCount,
          self.nsCount,
-         self.arCount) = struct.unpack('!HHHHHH', bin)
+         self.arCount) = HEADER_STRUCT.unpack_from(bin, offset)
         return self
 
+    def rcode(self):
+        return self.bits & 0x000f
+
     def __repr__(self):
         return '<DnsHeader %d, %d questions, %d answers>' % (self.id, self.qdCount, self.anCount)
 
 
-class DnsResourceRecord:
-    pass
+SoaData = collections.namedtuple('SoaData', 'mname rname serial refresh retry expire minimum')
+DnskeyData = collections.namedtuple('DnskeyData', 'flags protocol algorithm key')
+DsData = collections.namedtuple('DsData', 'key_tag algorithm digest_type digest')
+
+
+def read_name(message, offset):
+    return '.'.join(DnsPacketConverter().readLabels(message, offset)[0])
+
+
+def read_strings(message, offset, end):
+    strings = []
+    while offset < end:
+        length = ord(message[offset])
+        if offset + 1 + length > end:
+            raise DnscryptException("Malformed resource record.")
+        strings.append(message[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    return strings
+
+
+def read_soa(message, offset, end):
+    converter = DnsPacketConverter()
+    (mname, offset) = converter.readLabels(message, offset)
+    (rname, offset) = converter.readLabels(message, offset)
+    return SoaData('.'.join(mname), '.'.join(rname), *struct.unpack_from('!IIIII', message, offset))
+
+
+# type -> function(message, rdata offset, rdata end) returning the decoded rdata
+RDATA_DECODERS = {
+    1: lambda message, offset, end: socket.inet_ntoa(message[offset:end]),
+    2: lambda message, offset, end: read_name(message, offset),
+    5: lambda message, offset, end: read_name(message, offset),
+    6: read_soa,
+    16: read_strings,
+    28: lambda message, offset, end: socket.inet_ntop(socket.AF_INET6, message[offset:end]),
+    43: lambda message, offset, end: DsData(*struct.unpack_from('!HBB', message, offset) +
+                                            (message[offset + 4:end],)),
+    48: lambda message, offset, end: DnskeyData(*struct.unpack_from('!HBB', message, offset) +
+                                                (message[offset + 4:end],)),
+}
+
+
+class DnsResourceRecord(object):
+    '''A resource record read in place from a DNS message.
+
+    Only type, class, TTL and rdata length are unpacked when the record is
+    read. The owner name, the raw rdata and the decoded value are taken from
+    the message on first access. value is an address string for A and
+    AAAA, a list of strings for TXT, a name for CNAME and NS, a named tuple
+    for SOA, DNSKEY and DS, and the raw rdata for other types.'''
+
+    __slots__ = ('type', 'rrclass', 'ttl', 'rdlength', '_message', '_offset', '_rdoffset', '_value')
+
+    def __init__(self, message, offset, rdoffset, type, rrclass, ttl, rdlength):
+        self._message = message
+        self._offset = offset
+        self._rdoffset = rdoffset
+        self.type = type
+        self.rrclass = rrclass
+        self.ttl = ttl
+        self.rdlength = rdlength
+        self._value = None
+
+    @property
+    def name(self):
+        return self._decode(lambda: DnsPacketConverter().readLabels(self._message, self._offset)[0])
+
+    @property
+    def rdata(self):
+        return self._message[self._rdoffset:self._rdoffset + self.rdlength]
+
+    @property
+    def value(self):
+        if self._value is None:
+            decoder = RDATA_DECODERS.get(self.type)
+            if decoder is None:
+                self._value = self.rdata
+            else:
+                end = self._rdoffset + self.rdlength
+                self._value = self._decode(lambda: decoder(self._message, self._rdoffset, end))
+        return self._value
+
+    def _decode(self, read):
+        try:
+            return read()
+        except (struct.error, IndexError, ValueError, socket.error):
+            raise DnscryptException("Malformed resource record.")
+
+    def __repr__(self):
+        return '<DnsResourceRecord %s type %d ttl %d>' % ('.'.join(self.name), self.type, self.ttl)
 
 
 class DnsAnswer(DnsResourceRecord):
-    pass
+    __slots__ = ()
 
 
 class DnsQuestion:
@@ -94,31 +198,35 @@ class DnsQuestion:
         self.qclass = 1  # the Internet
 
     def toBinary(self):
-        bin = ''
+        parts = []
         for label in self.labels:
             assert len(label) <= 63
-            bin += struct.pack('B', len(label))
-            bin += label
-        bin += '\0'  # Labels terminator
-        bin += struct.pack('!HH', self.qtype, self.qclass)
-        return bin
+            parts.append(chr(len(label)))
+            parts.append(label)
+        parts.append('\0')  # Labels terminator
+        parts.append(QUESTION_STRUCT.pack(self.qtype, self.qclass))
+        return ''.join(parts)
 
 
-class DnsPacket:
+class DnsPacket(object):
     def __init__(self, header=None):
         self.header = header
         self.questions = []
-        self.answers = []
+        self.answerRecords = []
+        self.authorityRecords = []
+        self.additionalRecords = []
 
     def addQuestion(self, question):
         self.header.qdCount += 1
         self.questions.append(question)
 
+    @property
+    def answers(self):
+        '''The raw rdata of the answer records.'''
+        return [record.rdata for record in self.answerRecords]
+
     def toBinary(self):
-        bin = self.header.toBinary()
-        for question in self.questions:
-            bin += question.toBinary()
-        return bin
+        return self.header.toBinary() + ''.join(question.toBinary() for question in self.questions)
 
     def __repr__(self):
         return '<DnsPacket %s>' % (self.header)
@@ -128,60 +236,98 @@ class DnscryptException(Exception):
     pass
 
 
-class BinReader(StringIO.StringIO):
-    def unpack(self, fmt):
-        size = struct.calcsize(fmt)
-        bin = self.read(size)
-        return struct.unpack(fmt, bin)
+class DnscryptTimeout(DnscryptException):
+    pass
 
 
 class DnsPacketConverter:
+    '''Parses DNS messages in place, by offset.
+
+    Fields are read with struct.unpack_from straight from the message, and
+    only labels and rdata are sliced out of it. Compressed names follow
+    their pointers, which must point backwards, so loops cannot occur.'''
+
+    MAX_POINTERS = 32  # per name
+
     def fromBinary(self, bin):
-        reader = BinReader(bin)
-        header = DnsHeader().fromBinary(reader)
-        packet = DnsPacket(header)
-        for qi in range(header.qdCount):
-            q = self.readQuestion(reader)
-            packet.questions.append(q)
-        for ai in range(header.anCount):
-            aa = self.readAnswer(reader)
-            packet.answers.append(aa)
+        if isinstance(bin, (memoryview, bytearray)):
+            bin = bin.tobytes() if isinstance(bin, memoryview) else str(bin)
+        try:
+            header = DnsHeader().fromBinary(bin)
+            packet = DnsPacket(header)
+            offset = 12
+            for qi in range(header.qdCount):
+                (q, offset) = self.readQuestion(bin, offset)
+                packet.questions.append(q)
+            for ai in range(header.anCount):
+                (aa, offset) = self.readRecord(bin, offset)
+                packet.answerRecords.append(aa)
+            for ni in range(header.nsCount):
+                (record, offset) = self.readRecord(bin, offset)
+                packet.authorityRecords.append(record)
+            for ri in range(header.arCount):
+                (record, offset) = self.readRecord(bin, offset)
+                packet.additionalRecords.append(record)
+        except (struct.error, IndexError):
+            raise DnscryptException("Malformed DNS message.")
         return packet
 
-    def readQuestion(self, reader):
+    def readQuestion(self, bin, offset):
         question = DnsQuestion()
-        question.labels = self.readLabels(reader)
-        (question.qtype, question.qclass) = reader.unpack('!HH')
-        return question
-
-    def readAnswer(self, reader):
-        answer = DnsAnswer()
-        answer.name = self.readLabels(reader)
-        (type, rrclass, ttl, rdlength) = reader.unpack('!HHiH')
-        answer.rdata = reader.read(rdlength)
-        return answer.rdata
-
-    def readLabels(self, reader):
+        (question.labels, offset) = self.readLabels(bin, offset)
+        (question.qtype, question.qclass) = QUESTION_STRUCT.unpack_from(bin, offset)
+        return question, offset + 4
+
+    def readAnswer(self, bin, offset):
+        return self.readRecord(bin, offset)
+
+    def readRecord(self, bin, offset):
+        rdoffset = self.skipLabels(bin, offset) + 10
+        (rtype, rrclass, ttl, rdlength) = RECORD_STRUCT.unpack_from(bin, rdoffset - 10)
+        if rdoffset + rdlength > len(bin):
+            raise DnscryptException("Malformed DNS message.")
+        answer = DnsAnswer(bin, offset, rdoffset, rtype, rrclass, ttl, rdlength)
+        return answer, rdoffset + rdlength
+
+    def skipLabels(self, bin, offset):
+        '''Return the offset after the name at offset, without reading it.'''
+        while True:
+            length = ord(bin[offset])
+            if length == 0:
+                return offset + 1
+            if length & 0b11000000:
+                if length & 0b11000000 != 0b11000000:
+                    raise DnscryptException("Invalid label type.")
+                return offset + 2
+            offset += 1 + length
+
+    def readLabels(self, bin, offset):
+        '''Read the name at offset, returning (labels, offset after the name).'''
         labels = []
+        end = None  # the name ends after its first compression pointer
+        pointers = 0
         while True:
-            (length,) = reader.unpack('B')
+            length = ord(bin[offset])
             if length == 0:
+                offset += 1
                 break
 
             # Compression
-            compressionMask = 0b11000000
-            if length & compressionMask:
-                byte1 = length & ~compressionMask
-                (byte2,) = reader.unpack('B')
-                offset = byte1 << 8 | byte2
-                oldPosition = reader.tell()
-                result = self.readLabels(reader)
-                reader.seek(oldPosition)
-                return result
-
-            label = reader.read(length)
-            labels.append(label)
-        return labels
+            if length & 0b11000000:
+                if length & 0b11000000 != 0b11000000:
+                    raise DnscryptException("Invalid label type.")
+                pointer = (length & 0b00111111) << 8 | ord(bin[offset + 1])
+                if pointer >= offset or pointers == self.MAX_POINTERS:
+                    raise DnscryptException("Invalid name compression pointer.")
+                pointers += 1
+                if end is None:
+                    end = offset + 2
+                offset = pointer
+                continue
+
+            labels.append(bin[offset + 1:offset + 1 + length])
+            offset += 1 + length
+        return labels, end if end is not None else offset
 
 
 class Certificate:
@@ -191,6 +337,7 @@ class Certificate:
         self.serial = int(bincert.encode('hex')[208:216], 16)
         self.cert_start = datetime.datetime.fromtimestamp(int(bincert.encode('hex')[216:224], 16))
         self.cert_end = datetime.datetime.fromtimestamp(int(bincert.encode('hex')[224:], 16))
+        self.resolver_pk = None  # set once the signature has been verified
 
     def expired(self):
         now = datetime.datetime.now()
@@ -198,6 +345,14 @@ class Certificate:
             return True
         return False
 
+    def expires_within(self, seconds):
+        return datetime.datetime.now() + datetime.timedelta(seconds=seconds) > self.cert_end
+
+    def past_fraction(self, fraction):
+        '''True once fraction of the validity period has elapsed.'''
+        lifetime = (self.cert_end - self.cert_start).total_seconds()
+        return datetime.datetime.now() >= self.cert_start + datetime.timedelta(seconds=fraction * lifetime)
+
 
 def find_certificates(resp):
     '''Find certificates in the response.'''
@@ -205,8 +360,359 @@ def find_certificates(resp):
             for m in re.finditer('DNSC\x00\x01\x00\x00', resp)]
 
 
-def get_public_key(ip, port, provider_key, provider_url):
-    '''Get public key from provider.'''
+class CryptoBackend:
+    '''The signature and box primitives of one crypto library.'''
+
+    def __init__(self, name, sign_open, box_keypair, box_beforenm, box_afternm,
+                 box_open_afternm, errors=(ValueError,), activate=None, close=None):
+        self.name = name
+        self.sign_open = sign_open
+        self.box_keypair = box_keypair
+        self.box_beforenm = box_beforenm
+        self.box_afternm = box_afternm
+        self.box_open_afternm = box_open_afternm
+        self.errors = errors  # exceptions raised for bad keys, boxes or signatures
+        self.activate = activate
+        self.close = close  # releases the backend's resources once it is replaced
+
+
+def load_pynacl():
+    import nacl.bindings
+    import nacl.exceptions
+    return CryptoBackend('libsodium',
+                         nacl.bindings.crypto_sign_open,
+                         nacl.bindings.crypto_box_keypair,
+                         nacl.bindings.crypto_box_beforenm,
+                         nacl.bindings.crypto_box_afternm,
+                         nacl.bindings.crypto_box_open_afternm,
+                         (ValueError, nacl.exceptions.CryptoError))
+
+
+def load_pysodium():
+    import pysodium
+    return CryptoBackend('pysodium',
+                         pysodium.crypto_sign_open,
+                         pysodium.crypto_box_keypair,
+                         pysodium.crypto_box_beforenm,
+                         pysodium.crypto_box_afternm,
+                         pysodium.crypto_box_open_afternm)
+
+
+def load_slownacl(use_numpy=False):
+    import ed25519py
+    from slownacl import salsa20
+    if use_numpy and salsa20.numpy is None:
+        raise ImportError("No module named numpy")
+
+    def activate():
+        salsa20.USE_NUMPY = use_numpy
+
+    return CryptoBackend('slownacl-numpy' if use_numpy else 'slownacl',
+                         ed25519py.crypto_sign_open,
+                         xsalsa20poly1305.box_curve25519xsalsa20poly1305_keypair,
+                         xsalsa20poly1305.box_curve25519xsalsa20poly1305_beforenm,
+                         xsalsa20poly1305.box_curve25519xsalsa20poly1305_afternm,
+                         xsalsa20poly1305.box_curve25519xsalsa20poly1305_open_afternm,
+                         activate=activate)
+
+
+def load_slownacl_pool(processes=None):
+    '''slownacl with the box operations run in worker processes.
+
+    Keeps slow pure-Python crypto from holding the GIL in the calling
+    process, and lets concurrent queries use several cores.'''
+    import ed25519py
+    from slownacl import pool
+    crypto_pool = pool.CryptoPool(processes)
+
+    def run(operation):
+        # pool failures are not bad keys or boxes, so they keep their own message
+        def call(*args):
+            try:
+                return operation(*args)
+            except pool.PoolTimeout:
+                raise DnscryptTimeout("Crypto pool timed out.")
+            except pool.PoolError:
+                raise DnscryptException("Crypto pool is closed.")
+        return call
+
+    return CryptoBackend('slownacl-pool',
+                         ed25519py.crypto_sign_open,
+                         run(crypto_pool.box_keypair),
+                         run(crypto_pool.box_beforenm),
+                         run(crypto_pool.box_afternm),
+                         run(crypto_pool.box_open_afternm),
+                         close=crypto_pool.close)
+
+
+# in order of preference; slownacl-pool is only used when asked for by name
+BACKEND_LOADERS = collections.OrderedDict([
+    ('libsodium', load_pynacl),
+    ('pysodium', load_pysodium),
+    ('slownacl-numpy', lambda: load_slownacl(True)),
+    ('slownacl', load_slownacl),
+    ('slownacl-pool', load_slownacl_pool),
+])
+
+backend = None
+
+
+def available_backends():
+    names = []
+    for name, loader in BACKEND_LOADERS.items():
+        try:
+            loaded = loader()
+        except ImportError:
+            continue
+        if loaded.close is not None:
+            loaded.close()
+        names.append(name)
+    return names
+
+
+def set_backend(name=None):
+    '''Select the crypto backend by name, or the preferred available one.
+
+    Without a name, the native libraries are only considered while
+    USE_LOCAL_LIBS is set. The backend that is replaced is closed.'''
+    global backend
+    if name is None:
+        names = BACKEND_LOADERS.keys()
+        if not USE_LOCAL_LIBS:
+            names = [n for n in names if n.startswith('slownacl')]
+    elif name in BACKEND_LOADERS:
+        names = [name]
+    else:
+        raise DnscryptException("Unknown crypto backend %s." % name)
+
+    for n in names:
+        try:
+            selected = BACKEND_LOADERS[n]()
+        except ImportError:
+            continue
+        if selected.activate is not None:
+            selected.activate()
+        (previous, backend) = (backend, selected)
+        if previous is not None and previous.close is not None:
+            previous.close()
+        return backend.name
+    if name is None:
+        raise DnscryptException("No crypto backend is available.")
+    raise DnscryptException("Crypto backend %s is not available." % name)
+
+
+def backend_name():
+    return backend.name
+
+
+def init_backend():
+    name = os.environ.get('DNSCRYPT_BACKEND') or None
+    try:
+        set_backend(name)
+    except DnscryptException as e:
+        warnings.warn("%s Falling back to the default backend." % e, RuntimeWarning)
+        set_backend()
+
+
+class Metrics:
+    '''Receives instrumentation events from the query paths.
+
+    Phase durations are reported to timing(), in seconds: certificate,
+    keypair, nmkey, build, encode, network, decode and parse. Counters go to
+    increment(): queries, cache_hits, bytes_sent, bytes_received,
+    backend.<name> and error.<exception class>. Subclass and override the
+    methods of interest, then install the instance with set_metrics().'''
+
+    def timing(self, name, seconds):
+        pass
+
+    def increment(self, name, value=1):
+        pass
+
+
+class Histogram:
+    '''Counts of values in power-of-two buckets starting at MINIMUM.'''
+
+    MINIMUM = 1e-6
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value <= self.MINIMUM:
+            index = 0
+        else:
+            index = min(int(math.log(value / self.MINIMUM, 2)) + 1, self.BUCKETS - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        '''Upper bound of the bucket holding the q-th percentile.'''
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for (index, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(self.MINIMUM * 2 ** index, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+
+class MetricsAggregator(Metrics):
+    '''Keeps counters and a histogram per phase in memory.'''
+
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(Histogram)
+        self._lock = threading.Lock()
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.histograms[name].add(seconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'timings': dict((name, h.summary()) for name, h in self.histograms.items())}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+class Stopwatch:
+    '''Reports the phases and counters of one query to a Metrics sink.
+
+    lap() reports the time since the previous lap as the duration of a
+    phase.'''
+
+    __slots__ = ('metrics', 'last')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.last = time.time()
+
+    def lap(self, name):
+        now = time.time()
+        self.metrics.timing(name, now - self.last)
+        self.last = now
+
+    def reset(self):
+        self.last = time.time()
+
+    def increment(self, name, value=1):
+        self.metrics.increment(name, value)
+
+    def error(self, e):
+        self.metrics.increment('error.' + type(e).__name__)
+
+
+class NullStopwatch(Stopwatch):
+    '''The Stopwatch of queries made while instrumentation is off.'''
+
+    __slots__ = ()
+
+    def __init__(self):
+        pass
+
+    def lap(self, name):
+        pass
+
+    def reset(self):
+        pass
+
+    def increment(self, name, value=1):
+        pass
+
+    def error(self, e):
+        pass
+
+
+NO_STOPWATCH = NullStopwatch()
+
+# instrumentation is off while this is None, leaving only no-op calls per phase
+metrics = None
+
+
+def query_stopwatch():
+    '''Count a new query and return the Stopwatch for its phases.'''
+    if metrics is None:
+        return NO_STOPWATCH
+    metrics.increment('queries')
+    metrics.increment('backend.' + backend.name)
+    return Stopwatch(metrics)
+
+
+def set_metrics(sink):
+    '''Install a Metrics instance, or None to turn instrumentation off.'''
+    global metrics
+    metrics = sink
+
+
+class SingleFlight:
+    '''Coalesces concurrent calls with the same key into one.
+
+    The first caller for a key runs the call; callers arriving while it is
+    in flight wait for it and share its result or exception. saved counts
+    the calls that were avoided.'''
+
+    def __init__(self):
+        self.saved = 0
+        self._calls = {}  # key -> [done event, result, error]
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = [threading.Event(), None, None]
+                leader = True
+            else:
+                self.saved += 1
+                leader = False
+
+        if not leader:
+            if metrics is not None:
+                metrics.increment('coalesced')
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = function(*args)
+            return call[1]
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+
+
+def fetch_certificate(ip, port, provider_key, provider_url, timeout=None):
+    '''Fetch the provider's certificate and verify its signature.'''
+    start = time.time()
     header = DnsHeader()
 
     question = DnsQuestion()
@@ -218,10 +724,15 @@ def get_public_key(ip, port, provider_key, provider_url):
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.settimeout(timeout)
     dest = (ip, port)
-    sock.sendto(packet.toBinary(), dest)
-
-    (response, address) = sock.recvfrom(1024)
+    try:
+        sock.sendto(packet.toBinary(), dest)
+        (response, address) = sock.recvfrom(1024)
+    except socket.timeout:
+        raise DnscryptTimeout("Certificate request timed out.")
+    finally:
+        sock.close()
 
     bincerts = find_certificates(response)
 
@@ -238,122 +749,651 @@ def get_public_key(ip, port, provider_key, provider_url):
     if certificate.expired():
         raise DnscryptException("Certificate expired.")
 
-    if USE_LOCAL_LIBS:
-        try:
-            import pysodium
-            return pysodium.crypto_sign_open(certificate.bincert, provider_key.decode('hex')), certificate.magic_query
-        except ImportError:
-            pass
+    signed = verify_certificate(certificate.bincert, provider_key.decode('hex'))
+    certificate.resolver_pk = signed[:32]
+    if metrics is not None:
+        metrics.timing('certificate', time.time() - start)
+    return certificate
 
+
+def verify_certificate(bincert, provider_pk):
+    try:
+        return backend.sign_open(bincert, provider_pk)
+    except backend.errors:
+        raise DnscryptException("Invalid certificate signature.")
+
+
+def get_public_key(ip, port, provider_key, provider_url):
+    '''Get public key from provider.'''
+    certificate = fetch_certificate(ip, port, provider_key, provider_url)
+    return certificate.bincert[64:], certificate.magic_query
+
+
+class PersistentStore:
+    '''Verified certificates and unexpired answers kept in an sqlite file.
+
+    Lets restarted processes, and other processes on the same host, skip
+    certificate fetches and start with a warm answer cache. The database is
+    opened on first use in WAL mode, so several processes can read and
+    write it at once. Errors are treated like cache misses.
+
+    The file is trusted: answers read back from it are served as they are,
+    so whoever can write it can answer any query. It is created readable
+    and writable by its owner only, and should be kept in a directory other
+    users can't write to. Certificates are checked again when read back,
+    so a damaged row is fetched again instead of used.'''
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS certificates (
+            ip TEXT, port INTEGER, provider_key TEXT, provider_url TEXT,
+            bincert BLOB, resolver_pk BLOB,
+            PRIMARY KEY (ip, port, provider_key, provider_url))''',
+        '''CREATE TABLE IF NOT EXISTS answers (
+            name TEXT, qtype INTEGER, qclass INTEGER,
+            expires REAL, added REAL, message BLOB,
+            PRIMARY KEY (name, qtype, qclass))''',
+    ]
+
+    def __init__(self, path, timeout=10.0):
+        self.path = path
+        self.timeout = timeout
+        self._db = None
+        self._lock = threading.Lock()
+
+    def certificate(self, key):
+        '''Return (bincert, resolver_pk) stored for key, or None.'''
+        row = self._fetch('SELECT bincert, resolver_pk FROM certificates WHERE ip = ? AND port = ? '
+                          'AND provider_key = ? AND provider_url = ?', key)
+        return (str(row[0]), str(row[1])) if row else None
+
+    def add_certificate(self, key, certificate):
+        self._execute('INSERT OR REPLACE INTO certificates VALUES (?, ?, ?, ?, ?, ?)',
+                      key + (buffer(certificate.bincert), buffer(certificate.resolver_pk)))
+
+    def remove_certificate(self, key):
+        self._execute('DELETE FROM certificates WHERE ip = ? AND port = ? '
+                      'AND provider_key = ? AND provider_url = ?', key)
+
+    def answer(self, key):
+        '''Return (expires, message, added) for an unexpired answer, or None.'''
+        row = self._fetch('SELECT expires, message, added FROM answers '
+                          'WHERE name = ? AND qtype = ? AND qclass = ? AND expires > ?',
+                          key + (time.time(),))
+        return (row[0], str(row[1]), row[2]) if row else None
+
+    def add_answer(self, key, expires, message, added):
+        self._execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)',
+                      key + (expires, added, buffer(message)))
+
+    def prune(self):
+        '''Delete the expired answers.'''
+        self._execute('DELETE FROM answers WHERE expires <= ?', (time.time(),))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            try:
+                os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            except OSError:
+                pass  # sqlite3 reports the error
+            db = sqlite3.connect(self.path, self.timeout, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with db:
+                for statement in self.SCHEMA:
+                    db.execute(statement)
+                db.execute('DELETE FROM answers WHERE expires <= ?', (time.time(),))
+            self._db = db
+        return self._db
+
+    def _fetch(self, statement, parameters):
+        with self._lock:
+            try:
+                return self._connect().execute(statement, parameters).fetchone()
+            except sqlite3.Error:
+                return None
+
+    def _execute(self, statement, parameters):
+        with self._lock:
+            try:
+                db = self._connect()
+                with db:
+                    db.execute(statement, parameters)
+            except sqlite3.Error:
+                pass
+
+
+class CertificateCache:
+    '''Verified certificates keyed by (ip, port, provider_key, provider_url).
+
+    A certificate is served until its cert_end. Once it is within
+    refresh_margin seconds of expiring, or past refresh_fraction of its
+    validity period when that is set, lookups keep returning it while a
+    background thread fetches its successor. Concurrent fetches for the
+    same resolver are coalesced into one. Certificates are also kept in
+    store, a PersistentStore, when one is set.'''
+
+    REFRESH_RETRY = 60  # seconds between background refresh attempts
+
+    def __init__(self, refresh_margin=600, timeout=5.0, refresh_fraction=None, store=None):
+        self.refresh_margin = refresh_margin
+        self.refresh_fraction = refresh_fraction
+        self.timeout = timeout
+        self.store = store
+        self._certificates = {}
+        self._fetched = {}
+        self._refreshing = set()
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+
+    def get(self, ip, port, provider_key, provider_url, timeout=None):
+        '''Return the certificate for a resolver, fetching it within timeout
+        seconds, or the cache's timeout, when none is cached.'''
+        key = (ip, port, provider_key, provider_url)
+        with self._lock:
+            certificate = self._certificates.get(key)
+        if certificate is None and self.store is not None:
+            certificate = self._load(key)
+        if certificate is None or certificate.expired():
+            return self.refresh(ip, port, provider_key, provider_url, timeout)
+        if (certificate.expires_within(self.refresh_margin) or
+                (self.refresh_fraction is not None and certificate.past_fraction(self.refresh_fraction))):
+            self._refresh_in_background(key)
+        return certificate
+
+    def refresh(self, ip, port, provider_key, provider_url, timeout=None):
+        key = (ip, port, provider_key, provider_url)
+        return self._flights.do(key, self._fetch, key, self.timeout if timeout is None else timeout)
+
+    def _fetch(self, key, timeout):
+        (ip, port, provider_key, provider_url) = key
+        with self._lock:
+            self._fetched[key] = time.time()
+        certificate = fetch_certificate(ip, port, provider_key, provider_url, timeout)
+        with self._lock:
+            self._certificates[key] = certificate
+        if self.store is not None:
+            self.store.add_certificate(key, certificate)
+        return certificate
+
+    def invalidate(self, ip, port, provider_key, provider_url):
+        key = (ip, port, provider_key, provider_url)
+        with self._lock:
+            self._certificates.pop(key, None)
+            self._fetched.pop(key, None)
+        if self.store is not None:
+            self.store.remove_certificate(key)
+
+    def clear(self):
+        with self._lock:
+            self._certificates.clear()
+            self._fetched.clear()
+
+    def _load(self, key):
+        stored = self.store.certificate(key)
+        if stored is None:
+            return None
+        # the resolver key is taken from the signed certificate, not the
+        # stored copy, so a damaged row is never used
         try:
-            import nacl
-            import nacl.bindings
-            return nacl.bindings.crypto_sign_open(certificate.bincert, provider_key.decode('hex')), certificate.magic_query
-        except ImportError:
-            pass
+            certificate = Certificate(stored[0])
+            signed = verify_certificate(certificate.bincert, key[2].decode('hex'))
+        except (DnscryptException, ValueError, TypeError):
+            return None
+        certificate.resolver_pk = signed[:32]
+        if certificate.expired():
+            return None
+        with self._lock:
+            self._certificates.setdefault(key, certificate)
+        return certificate
+
+    def _refresh_in_background(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            if time.time() - self._fetched.get(key, 0) < self.REFRESH_RETRY:
+                return
+            self._refreshing.add(key)
+        thread = threading.Thread(target=self._background_refresh, args=(key,))
+        thread.daemon = True
+        thread.start()
+
+    def _background_refresh(self, key):
+        try:
+            self.refresh(*key)
+        except (DnscryptException, socket.error, ValueError):
+            pass  # keep serving the current certificate until it expires
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
 
-    import ed25519py
-    return ed25519py.crypto_sign_open(certificate.bincert, provider_key.decode('hex')), certificate.magic_query
+
+certificate_cache = CertificateCache()
+
+
+def get_certificate(cache, ip, port, provider_key, provider_url, timeout=None):
+    '''Get a resolver's certificate from cache. Failures other than a
+    timeout are reported as "Certificate expired.".'''
+    try:
+        return cache.get(ip, port, provider_key, provider_url, timeout)
+    except DnscryptTimeout:
+        raise
+    except DnscryptException:
+        raise DnscryptException("Certificate expired.")
 
 
 def generate_keypair():
-    if USE_LOCAL_LIBS:
-        try:
-            import nacl
-            import nacl.bindings
-            return nacl.bindings.crypto_box_keypair()
-        except ImportError:
-            pass
-    return xsalsa20poly1305.box_curve25519xsalsa20poly1305_keypair()
+    return backend.box_keypair()
 
 
 def create_nmkey(pk, sk):
     try:
-        if USE_LOCAL_LIBS:
-            try:
-                import nacl
-                import nacl.bindings
-                return nacl.bindings.crypto_box_beforenm(pk, sk)
-            except ImportError:
-                pass
-        return xsalsa20poly1305.box_curve25519xsalsa20poly1305_beforenm(pk, sk)
-    except ValueError:
+        return backend.box_beforenm(pk, sk)
+    except backend.errors:
         raise DnscryptException("Invalid public key.")
 
 
+class KeyManager:
+    '''Client keypairs and precomputed shared keys, one per resolver public key.
+
+    A keypair and its nmkey are reused until they have served max_queries
+    queries or are older than max_age seconds; either limit may be None.
+    KeyManager(max_queries=1) generates a fresh keypair for every query.
+    Keys for one resolver are generated by one caller at a time, and
+    callers that waited take the new key while it has uses left.'''
+
+    def __init__(self, max_queries=None, max_age=300):
+        self.max_queries = max_queries
+        self.max_age = max_age
+        self._keys = {}  # resolver_pk -> [pk, nmkey, created, uses]
+        self._generating = {}  # resolver_pk -> lock held while its keys are generated
+        self._lock = threading.Lock()
+
+    def get(self, resolver_pk):
+        '''Return (pk, nmkey) to use for the next query to resolver_pk.'''
+        with self._lock:
+            keys = self._use(resolver_pk)
+            if keys is not None:
+                return keys
+            generating = self._generating.setdefault(resolver_pk, threading.Lock())
+        with generating:
+            with self._lock:
+                keys = self._use(resolver_pk)  # generated while this caller waited
+            if keys is not None:
+                return keys
+            return self._generate(resolver_pk)
+
+    def _use(self, resolver_pk):
+        entry = self._keys.get(resolver_pk)
+        if entry is None or self._exhausted(entry):
+            return None
+        entry[3] += 1
+        return entry[0], entry[1]
+
+    def _generate(self, resolver_pk):
+        if metrics is None:
+            (pk, sk) = generate_keypair()
+            nmkey = create_nmkey(resolver_pk, sk)
+        else:
+            watch = Stopwatch(metrics)
+            (pk, sk) = generate_keypair()
+            watch.lap('keypair')
+            nmkey = create_nmkey(resolver_pk, sk)
+            watch.lap('nmkey')
+
+        with self._lock:
+            for stale in [k for k, e in self._keys.items() if self._exhausted(e)]:
+                del self._keys[stale]
+                if stale != resolver_pk:
+                    self._generating.pop(stale, None)
+            self._keys[resolver_pk] = [pk, nmkey, time.time(), 1]
+        return pk, nmkey
+
+    def rotate(self, resolver_pk=None):
+        '''Drop the keys for resolver_pk, or all keys, forcing new ones.'''
+        with self._lock:
+            if resolver_pk is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(resolver_pk, None)
+
+    def _exhausted(self, entry):
+        if self.max_queries is not None and entry[3] >= self.max_queries:
+            return True
+        if self.max_age is not None and time.time() - entry[2] >= self.max_age:
+            return True
+        return False
+
+
+key_manager = KeyManager()
+
+
 def encode_message(message, nonce, nmkey):
     try:
-        if USE_LOCAL_LIBS:
-            try:
-                import nacl
-                import nacl.bindings
-                return nacl.bindings.crypto_box_afternm(message, nonce + 12 * '\x00', nmkey)
-            except ImportError:
-                pass
-        return xsalsa20poly1305.box_curve25519xsalsa20poly1305_afternm(message, nonce + 12 * '\x00', nmkey)
-    except ValueError:
+        return backend.box_afternm(message, nonce + 12 * '\x00', nmkey)
+    except backend.errors:
         raise DnscryptException("Message encoding error.")
 
 
 def decode_message(answer, nonce, nmkey):
     try:
-        if USE_LOCAL_LIBS:
-            try:
-                import nacl
-                import nacl.bindings
-                return nacl.bindings.crypto_box_open_afternm(answer, nonce, nmkey)
-            except ImportError:
-                pass
-        return xsalsa20poly1305.box_curve25519xsalsa20poly1305_open_afternm(answer, nonce, nmkey)
-    except ValueError:
+        return backend.box_open_afternm(answer, nonce, nmkey)
+    except backend.errors:
         raise DnscryptException("Message decoding error.")
 
 
-def query(url, ip, port, provider_key, provider_url, record_type=1, return_packet=True):
-    # get public key from provider
-    try:
-        provider_pk, magic_query = get_public_key(ip, port, provider_key, provider_url)
-    except DnscryptException:
-        raise DnscryptException("Certificate expired.")
+class CountMinSketch:
+    '''Approximate hit counts for any number of keys in fixed memory.
+
+    Each key increments one counter in each of depth rows of width
+    counters; its estimate is the smallest of them, which never
+    undercounts. All counters are halved every decay_interval additions,
+    so the counts follow recent popularity.'''
+
+    def __init__(self, width=4096, depth=4, decay_interval=100000):
+        self.width = width
+        self.depth = depth
+        self.decay_interval = decay_interval
+        self._rows = [array.array('L', [0]) * width for i in range(depth)]
+        self._additions = 0
+
+    def add(self, key):
+        '''Count a hit for key and return its new estimate.'''
+        estimate = None
+        for (i, row) in enumerate(self._rows):
+            index = hash((i, key)) % self.width
+            row[index] += 1
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        self._additions += 1
+        if self._additions >= self.decay_interval:
+            self.decay()
+        return estimate
+
+    def estimate(self, key):
+        return min(row[hash((i, key)) % self.width] for (i, row) in enumerate(self._rows))
+
+    def decay(self):
+        self._additions = 0
+        for row in self._rows:
+            for index in range(self.width):
+                row[index] >>= 1
+
+
+class Prefetcher:
+    '''Refreshes popular cache entries before they expire.
+
+    hit() is called for each cache hit with the entry's lifetime. When the
+    entry is past fraction of its lifetime and has been hit at least
+    min_hits times recently, refresh(name, qtype) is run for it by one of
+    workers background threads. Popularity is kept in a CountMinSketch.
+    close() stops the threads; hits after that are ignored.'''
+
+    def __init__(self, refresh, fraction=0.8, min_hits=2, workers=2, sketch=None):
+        self.refresh = refresh
+        self.fraction = fraction
+        self.min_hits = min_hits
+        self.sketch = sketch or CountMinSketch()
+        self.prefetches = 0
+        self._queue = Queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def hit(self, key, added, expires):
+        with self._lock:
+            if self._closed:
+                return
+            hits = self.sketch.add(key)
+            if time.time() < added + self.fraction * (expires - added) or hits < self.min_hits:
+                return
+            if key in self._queued:
+                return
+            self._queued.add(key)
+        self._queue.put(key)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            if key is None:
+                return
+            try:
+                self.refresh(key[0], key[1])
+                self.prefetches += 1
+            except (DnscryptException, socket.error):
+                pass  # the entry expires and the next lookup tries again
+            finally:
+                with self._lock:
+                    self._queued.discard(key)
+
+
+class AnswerCache:
+    '''Decoded responses keyed by (name, qtype, qclass), kept for their TTL.
+
+    Positive answers live for the smallest TTL in the answer section.
+    NXDOMAIN and NODATA responses live for the SOA minimum (RFC 2308) and
+    are not cached without an SOA. At most max_entries responses are kept,
+    evicting the least recently used. Hits are reported to prefetcher, a
+    Prefetcher, when one is set. With a PersistentStore as store, answers
+    are also written to it and misses are looked up there.'''
+
+    def __init__(self, max_entries=4096, max_ttl=86400, prefetcher=None, store=None):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.prefetcher = prefetcher
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # key -> (expires, message, packet, added)
+        self._lock = threading.Lock()
+
+    def get(self, name, qtype, qclass=1):
+        '''Return (message, packet) for an unexpired response, or None.'''
+        key = (name.lower().rstrip('.'), qtype, qclass)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] <= time.time():
+                entry = None
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+        if entry is None and self.store is not None:
+            entry = self._load(key)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        if self.prefetcher is not None:
+            self.prefetcher.hit(key, entry[3], entry[0])
+        return entry[1], entry[2]
+
+    def expires(self, name, qtype, qclass=1):
+        '''Return when the cached response expires, or None if there is none.'''
+        key = (name.lower().rstrip('.'), qtype, qclass)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[0]
+
+    def add(self, name, qtype, message, qclass=1):
+        '''Parse message and cache it if its TTL allows. Returns the parsed
+        packet, or None when message cannot be parsed.'''
+        try:
+            packet = DnsPacketConverter().fromBinary(message)
+        except DnscryptException:
+            return None
+        ttl = min(self.ttl(packet), self.max_ttl)
+        if ttl <= 0:
+            return packet
+
+        key = (name.lower().rstrip('.'), qtype, qclass)
+        now = time.time()
+        self._insert(key, (now + ttl, message, packet, now))
+        if self.store is not None:
+            self.store.add_answer(key, now + ttl, message, now)
+        return packet
 
-    # create dns query
-    header = DnsHeader()
+    def ttl(self, packet):
+        rcode = packet.header.rcode()
+        if rcode == 0 and packet.answerRecords:
+            return min(record.ttl for record in packet.answerRecords)
+        if rcode in (0, 3):  # NODATA or NXDOMAIN
+            for record in packet.authorityRecords:
+                if record.type == 6 and len(record.rdata) >= 20:  # SOA
+                    (minimum,) = struct.unpack('!I', record.rdata[-4:])
+                    return min(record.ttl, minimum)
+        return 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    def _insert(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _load(self, key):
+        stored = self.store.answer(key)
+        if stored is None:
+            return None
+        (expires, message, added) = stored
+        try:
+            packet = DnsPacketConverter().fromBinary(message)
+        except DnscryptException:
+            return None
+        entry = (expires, message, packet, added)
+        self._insert(key, entry)
+        with self._lock:
+            self.hits += 1
+        return entry
 
-    question = DnsQuestion()
-    question.labels = url.split('.')
-    question.qtype = record_type
 
-    packet = DnsPacket(header)
-    packet.addQuestion(question)
+answer_cache = AnswerCache()
+
+
+def set_store(store):
+    '''Keep the module's certificates and answers in store, a PersistentStore, or None.'''
+    certificate_cache.store = store
+    answer_cache.store = store
+
+
+class QueryBuilder:
+    '''Encodes queries from cached per-(name, qtype) templates.
+
+    A template holds the header, the question and an EDNS0 OPT record
+    advertising payload_size, followed by the 0x80 padding byte. Building a
+    query copies the template into a bytearray and patches in a random ID.
+    The DO bit is set for DNSSEC record types.'''
+
+    DNSSEC_TYPES = (43, 46, 48)  # DS, RRSIG, DNSKEY
+    DNSSEC_PAYLOAD_SIZE = 1280  # minimum advertised with the DO bit
+
+    def __init__(self, payload_size=1252, max_templates=1024):
+        self.payload_size = payload_size
+        self.max_templates = max_templates
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def build(self, name, qtype=1):
+        template = self._templates.get((name, qtype))
+        if template is None:
+            template = self.template(name, qtype)
+            with self._lock:
+                if len(self._templates) >= self.max_templates:
+                    self._templates.popitem()
+                self._templates[(name, qtype)] = template
+
+        message = bytearray(template)
+        ID_STRUCT.pack_into(message, 0, random.getrandbits(16))
+        return str(message)
+
+    def template(self, name, qtype):
+        header = DnsHeader()
+
+        question = DnsQuestion()
+        question.labels = name.rstrip('.').split('.')
+        question.qtype = qtype
+        if not all(0 < len(label) <= 63 for label in question.labels):
+            raise DnscryptException("Invalid domain name.")
+
+        packet = DnsPacket(header)
+        packet.addQuestion(question)
+
+        if qtype in self.DNSSEC_TYPES:
+            opt = RECORD_STRUCT.pack(41, max(self.payload_size, self.DNSSEC_PAYLOAD_SIZE), 0x8000, 0)
+        else:
+            opt = RECORD_STRUCT.pack(41, self.payload_size, 0, 0)
+        return bytearray(packet.toBinary() + '\x00' + opt + '\x80')
+
+
+query_builder = QueryBuilder()
+
+
+def build_query(url, record_type=1):
+    '''Build the plain DNS query message for url.'''
+    return query_builder.build(url, record_type)
 
-    # generate a local keypair
-    (pk, sk) = generate_keypair()
 
-    # create nmkey out of provider's public key and local secret key
-    nmkey = create_nmkey(provider_pk[:32], sk)
+nonce_counter = itertools.count()
 
-    message = packet.toBinary() + '\x00\x00\x29\x04\xe4' + 6 * '\x00' + '\x80'
 
-    # custom rules for type 48
-    if record_type == 48:
-        url_part = ''
-        for part in question.labels:
-            url_part += chr(len(part)) + part
-        message = '\x124\x01\x00\x00\x01\x00\x00\x00\x00\x00\x01' + url_part + '\x00\x000\x00\x01\x00\x00)\x05\x00\x00\x00\x80\x00\x00\x00\x80'
+def make_nonce():
+    '''Return a 12 byte client nonce that is never repeated by this process.
 
-    nonce = "%x" % int(time.time()) + os.urandom(4).encode('hex')[4:]
+    Keypairs and their nmkey are reused across queries, so a repeated nonce
+    would repeat the XSalsa20 keystream and Poly1305 key. The timestamp and
+    the counter keep nonces unique within the process, and the random tail
+    keeps forked processes sharing a key apart.'''
+    counter = next(nonce_counter) & 0xffffffff
+    return NONCE_STRUCT.pack(int(time.time()) & 0xffffffff, counter) + os.urandom(4)
+
+
+def encrypt_query(message, magic_query, pk, nmkey, nonce=None):
+    '''Encrypt message for the resolver, returning (request, client nonce).'''
+    if nonce is None:
+        nonce = make_nonce()
 
     encoded_message = encode_message(message, nonce, nmkey)
 
-    #poly = poly1305.onetimeauth_poly1305(encoded_message, provider_pk[:32])  not quite sure if that's needed for something...
+    #poly = poly1305.onetimeauth_poly1305(encoded_message, resolver_pk)  not quite sure if that's needed for something...
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    dest = (ip, port)
+    return magic_query + pk + nonce + encoded_message, nonce
 
-    sock.sendto(magic_query + pk + nonce + encoded_message, dest)
-    (response, address) = sock.recvfrom(2048)
 
+def decrypt_response(response, nonce, nmkey):
+    '''Check and decrypt a resolver response to the query sent with nonce.'''
     resp_magic_query = response[:8]
     resp_client_nonce = response[8:20]
     resp_server_nonce = response[20:32]
@@ -364,13 +1404,1092 @@ def query(url, ip, port, provider_key, provider_url, record_type=1, return_packe
     if resp_client_nonce != nonce:
         raise DnscryptException("Invalid nonce received.")
 
-    decoded_answer = decode_message(resp_answer, resp_client_nonce + resp_server_nonce, nmkey)
+    message = decode_message(resp_answer, resp_client_nonce + resp_server_nonce, nmkey)
+    # strip the ISO/IEC 7816-4 padding: 0x80 followed by zeros
+    end = message.rfind('\x80')
+    if end < 0 or message[end + 1:].strip('\x00'):
+        raise DnscryptException("Invalid response padding.")
+    return message[:end]
+
+
+def truncated(message):
+    '''True when the TC bit of a decrypted DNS message is set.'''
+    return len(message) >= 4 and bool(ord(message[2]) & 0x02)
+
+
+def frame(request):
+    '''Prefix a request with its two-byte length for TCP.'''
+    return struct.pack('!H', len(request)) + request
+
+
+def read_frame(sock):
+    (length,) = struct.unpack('!H', recv_exactly(sock, 2))
+    return recv_exactly(sock, length)
+
+
+def recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise DnscryptException("Connection closed.")
+        data += chunk
+    return data
+
+
+def query_tcp(ip, port, message, magic_query, pk, nmkey, timeout=None):
+    '''Send message over a new TCP connection and return the decrypted answer.'''
+    (request, nonce) = encrypt_query(message, magic_query, pk, nmkey)
+    try:
+        sock = socket.create_connection((ip, port), timeout)
+    except socket.timeout:
+        raise DnscryptTimeout("Request timed out.")
+    try:
+        sock.sendall(frame(request))
+        response = read_frame(sock)
+    except socket.timeout:
+        raise DnscryptTimeout("Request timed out.")
+    finally:
+        sock.close()
+    return decrypt_response(response, nonce, nmkey)
+
+
+query_flights = SingleFlight()
+
+
+def query(url, ip, port, provider_key, provider_url, record_type=1, return_packet=True, tcp=False,
+          timeout=5.0):
+    '''Resolve url through the resolver at ip:port.
+
+    Concurrent calls for the same name, type and resolver share a single
+    upstream query.'''
+    key = (url.lower().rstrip('.'), record_type, return_packet, ip, port, provider_key, provider_url, tcp)
+    return query_flights.do(key, _query, url, ip, port, provider_key, provider_url,
+                            record_type, return_packet, tcp, timeout)
+
 
-    # returns answer not converted to packet
-    if not return_packet:
-        return decoded_answer
+def _query(url, ip, port, provider_key, provider_url, record_type, return_packet, tcp, timeout):
+    def certificate():
+        # get the provider's certificate, fetching it only when the cached one expires
+        return get_certificate(certificate_cache, ip, port, provider_key, provider_url, timeout)
+
+    def exchange(request, nonce):
+        return udp_exchange(ip, port, request, timeout)
+
+    def exchange_tcp(message, magic_query, pk, nmkey):
+        return query_tcp(ip, port, message, magic_query, pk, nmkey, timeout)
+
+    return run_query(url, record_type, answer_cache, certificate, key_manager, exchange,
+                     exchange_tcp, tcp, return_packet)
+
+
+def udp_exchange(ip, port, request, timeout=None):
+    '''Send request from a new UDP socket and return the response.'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(request, (ip, port))
+        (response, address) = sock.recvfrom(65535)
+    except socket.timeout:
+        raise DnscryptTimeout("Request timed out.")
+    finally:
+        sock.close()
+    return response
+
+
+def run_query(name, rtype, cache, certificate, keys, exchange, exchange_tcp, tcp=False,
+              return_packet=True, use_cache=True):
+    '''The query pipeline of query() and DnscryptResolver, with each phase
+    reported to the installed metrics.
+
+    certificate() returns the resolver's certificate and keys is a
+    KeyManager. exchange(request, nonce) sends an encrypted query over UDP
+    and returns the response. exchange_tcp(message, magic_query, pk, nmkey)
+    returns the decrypted answer to message over TCP; it is used for
+    truncated answers, or for every query with tcp=True.'''
+    watch = query_stopwatch()
+    try:
+        if use_cache:
+            cached = cache.get(name, rtype)
+            if cached is not None:
+                watch.increment('cache_hits')
+                (decoded_answer, packet) = cached
+                return packet if return_packet else decoded_answer
+
+        cert = certificate()
+        # local keypair and nmkey for the provider's public key, reused until rotated
+        (pk, nmkey) = keys.get(cert.resolver_pk)
+        watch.reset()  # fetches and key generation report their own timings
+
+        message = build_query(name, rtype)
+        watch.lap('build')
+        if tcp:
+            decoded_answer = exchange_tcp(message, cert.magic_query, pk, nmkey)
+            watch.lap('network')
+        else:
+            (request, nonce) = encrypt_query(message, cert.magic_query, pk, nmkey)
+            watch.lap('encode')
+            response = exchange(request, nonce)
+            watch.lap('network')
+            watch.increment('bytes_sent', len(request))
+            watch.increment('bytes_received', len(response))
+            decoded_answer = decrypt_response(response, nonce, nmkey)
+            watch.lap('decode')
+
+            # the answer did not fit in a datagram, ask again over TCP
+            if truncated(decoded_answer):
+                decoded_answer = exchange_tcp(message, cert.magic_query, pk, nmkey)
+                watch.lap('network')
+
+        packet = cache.add(name, rtype, decoded_answer)
+        if return_packet and packet is None:
+            packet = DnsPacketConverter().fromBinary(decoded_answer)
+        watch.lap('parse')
+        return packet if return_packet else decoded_answer
+    except Exception as e:
+        watch.error(e)
+        raise
+
+
+OpenAliasRecord = collections.namedtuple('OpenAliasRecord', 'currency address name fields')
+
+
+def openalias_entries(packet):
+    '''Yield (currency, body) for each oa1 TXT record in packet.
+
+    The character-strings of a record are joined before matching, as a
+    record may be split across several of them. The key=value fields in
+    body are left unparsed.'''
+    for record in packet.answerRecords:
+        if record.type != 16:
+            continue
+        text = ''.join(record.value)
+        if not text.startswith('oa1:'):
+            continue
+        (currency, sep, body) = text[4:].partition(' ')
+        yield currency.lower(), body
+
+
+def parse_openalias(currency, body):
+    '''Parse the key=value; fields of an oa1 record.'''
+    fields = collections.OrderedDict()
+    for field in body.split(';'):
+        (key, sep, value) = field.partition('=')
+        key = key.strip()
+        if key and sep:
+            fields[key] = value.strip()
+    return OpenAliasRecord(currency, fields.get('recipient_address'),
+                           fields.get('recipient_name'), fields)
+
+
+class OpenAliasCache:
+    '''The oa1 records of names, kept for as long as their answer is cached.
+
+    Each entry holds [currency, body, parsed record]; the fields of a
+    record are parsed the first time its currency is asked for. At most
+    max_entries names are kept, evicting the least recently used.'''
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # name -> (expires, entries)
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        key = name.lower().rstrip('.')
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return None
+            self._entries[key] = entry
+            return entry[1]
+
+    def add(self, name, entries, expires):
+        key = name.lower().rstrip('.')
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, entries)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+openalias_cache = OpenAliasCache()
+
+
+def resolve_openalias(name, ip, port, provider_key, provider_url, currency=None):
+    '''Return the OpenAlias records of name as OpenAliasRecord tuples.
+
+    With a currency, only the records for that currency are returned, and
+    only those are parsed. Parsed records are cached until the TXT answer
+    they came from expires from the answer cache.'''
+    entries = openalias_cache.get(name)
+    if entries is None:
+        packet = query(name, ip, port, provider_key, provider_url, record_type=16)
+        entries = [[c, body, None] for (c, body) in openalias_entries(packet)]
+        expires = answer_cache.expires(name, 16)
+        if expires is not None:
+            openalias_cache.add(name, entries, expires)
+
+    if currency is not None:
+        currency = currency.lower()
+    records = []
+    for entry in entries:
+        if currency is None or entry[0] == currency:
+            if entry[2] is None:
+                entry[2] = parse_openalias(entry[0], entry[1])
+            records.append(entry[2])
+    return records
+
+
+def resolve_many(names, ip, port, provider_key, provider_url, record_type=16, concurrency=32,
+                 timeout=5.0, tcp=False):
+    '''Resolve many names through one resolver.
+
+    Yields (name, packet) pairs in completion order, with the exception in
+    place of the packet for lookups that failed. The certificate, nmkey and
+    answers come from the same shared caches as query(). With tcp=True the
+    queries are pipelined over a single TCP connection.'''
+    try:
+        multiplexer = DnscryptMultiplexer(ip, port, provider_key, provider_url, timeout,
+                                          certificate_cache, key_manager, answer_cache, tcp)
+    except (DnscryptException, socket.error) as e:  # the TCP connection failed
+        for name in names:
+            yield name, e
+        return
+    try:
+        for result in multiplexer.resolve_many(names, record_type, concurrency):
+            yield result
+    finally:
+        multiplexer.close()
+
+
+class DnscryptResolver:
+    '''A DNSCrypt session with a single upstream resolver.
+
+    Keeps a pool of up to pool_size connected UDP sockets together with its
+    own certificate cache, key manager and answer cache. Truncated answers
+    are fetched again over TCP. Instances are safe to share between threads;
+    close() releases the sockets.
+
+    With prefetch set to a fraction, popular answers past that fraction of
+    their TTL are refreshed in the background by prefetcher, as is the
+    certificate. This only applies to the caches the resolver creates
+    itself: caches passed in are used as they are, and a shared answer
+    cache can be given the resolver's prefetcher explicitly. close() stops
+    the prefetcher.'''
+
+    def __init__(self, ip, port, provider_key, provider_url, pool_size=4, timeout=5.0,
+                 certificate_cache=None, key_manager=None, answer_cache=None, prefetch=None):
+        self.ip = ip
+        self.port = port
+        self.provider_key = provider_key
+        self.provider_url = provider_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.certificate_cache = certificate_cache or CertificateCache(timeout=timeout,
+                                                                       refresh_fraction=prefetch)
+        self.key_manager = key_manager or KeyManager()
+        self.prefetcher = Prefetcher(self.refresh, prefetch) if prefetch is not None else None
+        self.answer_cache = answer_cache or AnswerCache(prefetcher=self.prefetcher)
+        self.flights = SingleFlight()
+        self._idle = []
+        self._sockets = []
+        self._available = threading.Condition()  # signalled when a socket is released or discarded
+        self._closed = False
+
+    def certificate(self):
+        return get_certificate(self.certificate_cache, self.ip, self.port, self.provider_key,
+                               self.provider_url, self.timeout)
+
+    def resolve(self, name, rtype=1, return_packet=True):
+        '''Resolve name, sharing one upstream query between concurrent
+        callers asking for the same name and type.'''
+        return self.flights.do((name.lower().rstrip('.'), rtype, return_packet),
+                               self._resolve, name, rtype, return_packet)
+
+    def refresh(self, name, rtype=1):
+        '''Query name upstream even if it is cached, replacing the cached answer.'''
+        return self.flights.do((name.lower().rstrip('.'), rtype, 'refresh'),
+                               self._resolve, name, rtype, True, False)
+
+    def _resolve(self, name, rtype, return_packet, use_cache=True):
+        return run_query(name, rtype, self.answer_cache, self.certificate, self.key_manager,
+                         self.exchange, self._exchange_tcp, False, return_packet, use_cache)
+
+    def exchange(self, request, nonce):
+        '''Send an encrypted request and return the response carrying nonce.'''
+        sock = self._acquire()
+        try:
+            sock.send(request)
+            response = self._receive(sock, nonce)
+        except socket.timeout:
+            self._release(sock)
+            raise DnscryptTimeout("Request timed out.")
+        except socket.error:
+            self._discard(sock)
+            raise
+        self._release(sock)
+        return response
+
+    def close(self):
+        with self._available:
+            self._closed = True
+            sockets, self._sockets = self._sockets, []
+            self._idle = []
+            self._available.notify_all()
+        for sock in sockets:
+            sock.close()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _exchange_tcp(self, message, magic_query, pk, nmkey):
+        return query_tcp(self.ip, self.port, message, magic_query, pk, nmkey, self.timeout)
+
+    def _receive(self, sock, nonce):
+        # a pooled socket may still hold late answers to earlier, timed out
+        # queries, so skip anything that is not for this nonce
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        while True:
+            if deadline is not None:
+                sock.settimeout(max(deadline - time.time(), 0.001))
+            response = sock.recv(65535)
+            if response[8:20] == nonce:
+                return response
+
+    def _acquire(self):
+        # wait for an idle socket, or room in the pool for a new one, until
+        # the query would have timed out anyway
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        with self._available:
+            while True:
+                if self._closed:
+                    raise DnscryptException("Resolver is closed.")
+                if self._idle:
+                    return self._idle.pop()
+                if len(self._sockets) < self.pool_size:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.connect((self.ip, self.port))
+                    self._sockets.append(sock)
+                    return sock
+                if deadline is None:
+                    self._available.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DnscryptTimeout("Request timed out.")
+                self._available.wait(remaining)
+
+    def _release(self, sock):
+        with self._available:
+            if self._closed or sock not in self._sockets:
+                return
+            self._idle.append(sock)
+            self._available.notify()
+
+    def _discard(self, sock):
+        with self._available:
+            if sock in self._sockets:
+                self._sockets.remove(sock)
+            self._available.notify()
+        sock.close()
+
+
+class Upstream:
+    '''Smoothed round-trip time and health of one resolver in a group.
+
+    After MAX_FAILURES consecutive failures the upstream is unhealthy and
+    is skipped until its backoff, which doubles with every further
+    failure, has passed.'''
+
+    ALPHA = 0.125  # weight of a new RTT sample, as for TCP's SRTT
+    MAX_FAILURES = 3
+    BACKOFF = 5.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.srtt = None
+        self.failures = 0
+        self.retry_at = 0
+        self._lock = threading.Lock()
+
+    def healthy(self, now=None):
+        return self.failures < self.MAX_FAILURES or (now or time.time()) >= self.retry_at
+
+    def record_success(self, rtt):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+            else:
+                self.srtt += self.ALPHA * (rtt - self.srtt)
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.MAX_FAILURES:
+                backoff = self.BACKOFF * 2 ** (self.failures - self.MAX_FAILURES)
+                self.retry_at = time.time() + min(backoff, self.MAX_BACKOFF)
+
+    def resolve(self, name, rtype):
+        start = time.time()
+        try:
+            packet = self.resolver.resolve(name, rtype)
+        except (DnscryptException, socket.error):
+            self.record_failure()
+            raise
+        self.record_success(time.time() - start)
+        return packet
+
+    def __repr__(self):
+        return '<Upstream %s:%d srtt=%s failures=%d>' % (self.resolver.ip, self.resolver.port,
+                                                         self.srtt, self.failures)
+
+
+class DnscryptResolverGroup:
+    '''Resolves through the fastest healthy one of several DNSCrypt resolvers.
+
+    upstreams is a list of (ip, port, provider_key, provider_url) tuples.
+    Upstreams without recent failures come first; among those the ones
+    without an RTT sample are tried first, then the lowest smoothed RTT
+    wins. A failed query fails over to the next upstream. With
+    race=N a query is sent to the best N upstreams at once and the first
+    valid answer is returned.'''
+
+    def __init__(self, upstreams, race=1, timeout=5.0, pool_size=4,
+                 key_manager=None, answer_cache=None):
+        self.race = race
+        self.key_manager = key_manager or KeyManager()
+        self.answer_cache = answer_cache or AnswerCache()
+        self.upstreams = [Upstream(DnscryptResolver(ip, port, provider_key, provider_url,
+                                                    pool_size, timeout,
+                                                    key_manager=self.key_manager,
+                                                    answer_cache=self.answer_cache))
+                          for (ip, port, provider_key, provider_url) in upstreams]
+        self.flights = SingleFlight()
+
+    def ranked(self):
+        '''Upstreams in the order they would be tried, healthy ones first.'''
+        now = time.time()
+        healthy = [u for u in self.upstreams if u.healthy(now)]
+        unhealthy = [u for u in self.upstreams if not u.healthy(now)]
+        healthy.sort(key=lambda u: (u.failures, u.srtt is not None, u.srtt))
+        unhealthy.sort(key=lambda u: u.retry_at)
+        return healthy + unhealthy
+
+    def resolve(self, name, rtype=1, race=None):
+        cached = self.answer_cache.get(name, rtype)
+        if cached is not None:
+            query_stopwatch().increment('cache_hits')
+            return cached[1]
+        return self.flights.do((name.lower().rstrip('.'), rtype, race), self._resolve,
+                               name, rtype, race)
+
+    def _resolve(self, name, rtype, race):
+        upstreams = self.ranked()
+        race = race or self.race
+        if race > 1:
+            return self._race(upstreams[:race], name, rtype)
+
+        error = None
+        for upstream in upstreams:
+            try:
+                return upstream.resolve(name, rtype)
+            except (DnscryptException, socket.error) as e:
+                error = e
+        raise error or DnscryptException("No upstream resolvers.")
+
+    def close(self):
+        for upstream in self.upstreams:
+            upstream.resolver.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _race(self, upstreams, name, rtype):
+        results = Queue.Queue()
+
+        def run(upstream):
+            try:
+                results.put((upstream.resolve(name, rtype), None))
+            except (DnscryptException, socket.error) as e:
+                results.put((None, e))
+
+        for upstream in upstreams:
+            thread = threading.Thread(target=run, args=(upstream,))
+            thread.daemon = True
+            thread.start()
+
+        # the slower queries keep running and still update their upstream's RTT
+        error = None
+        for i in range(len(upstreams)):
+            (packet, error) = results.get()
+            if error is None:
+                return packet
+        raise error or DnscryptException("No upstream resolvers.")
+
+
+class PendingQuery:
+    '''A query sent through a DnscryptMultiplexer that may not be answered yet.'''
+
+    def __init__(self, name, rtype, nonce, nmkey, deadline, notify=None):
+        self.name = name
+        self.rtype = rtype
+        self.nonce = nonce
+        self.nmkey = nmkey
+        self.deadline = deadline
+        self.retry = None  # (message, magic_query, pk) to resend over TCP
+        self.followers = []  # identical queries waiting for this one's answer
+        self.watch = NO_STOPWATCH
+        self._notify = notify
+        self._done = threading.Event()
+        self._packet = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''Wait for the answer and return it, or raise the query's error.'''
+        if not self._done.wait(timeout):
+            raise DnscryptTimeout("Request timed out.")
+        if self._error is not None:
+            raise self._error
+        return self._packet
+
+    def _complete(self, packet=None, error=None):
+        self._packet = packet
+        self._error = error
+        self._done.set()
+        if self._notify is not None:
+            self._notify.put(self)
+        for follower in self.followers:
+            follower._complete(packet, error)
+
+
+class DnscryptMultiplexer:
+    '''Many in-flight queries to one resolver over a single socket.
+
+    submit() encrypts and sends a query without waiting for it. A receiver
+    thread matches responses to their queries by client nonce and expires
+    those that are not answered within timeout seconds. Queries found in
+    the answer cache complete without being sent, and queries for a name
+    and type already in flight wait for that query's answer; coalesced
+    counts them.
+
+    By default queries go over UDP and truncated answers are fetched again
+    over TCP. With tcp=True all queries are pipelined over one persistent
+    TCP connection, which is re-established if the server closes it.'''
+
+    TICK = 0.1  # seconds between checks for expired queries
+    MAX_BACKOFF = 2.0  # longest wait between TCP reconnection attempts
+
+    def __init__(self, ip, port, provider_key, provider_url, timeout=5.0,
+                 certificate_cache=None, key_manager=None, answer_cache=None, tcp=False):
+        self.ip = ip
+        self.port = port
+        self.provider_key = provider_key
+        self.provider_url = provider_url
+        self.timeout = timeout
+        self.tcp = tcp
+        self.certificate_cache = certificate_cache or CertificateCache(timeout=timeout)
+        self.key_manager = key_manager or KeyManager()
+        self.answer_cache = answer_cache or AnswerCache()
+        self.coalesced = 0
+        self._pending = {}  # client nonce -> PendingQuery
+        self._in_flight = {}  # (name, rtype) -> PendingQuery
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._connected = True  # False while a lost TCP connection is re-established
+        self._sock = self._connect()
+        self._receiver = threading.Thread(target=self._receive_loop)
+        self._receiver.daemon = True
+        self._receiver.start()
+
+    def submit(self, name, rtype=1, notify=None):
+        '''Send a query and return its PendingQuery.
+
+        When notify is a Queue, the PendingQuery is put on it once it has
+        been answered or has failed.'''
+        cached = self.answer_cache.get(name, rtype)
+        if cached is not None:
+            query_stopwatch().increment('cache_hits')
+            pending = PendingQuery(name, rtype, None, None, None, notify)
+            pending._complete(cached[1])
+            return pending
+
+        key = (name.lower().rstrip('.'), rtype)
+        with self._lock:
+            leader = self._in_flight.get(key)
+            if leader is not None:
+                follower = PendingQuery(name, rtype, None, None, leader.deadline, notify)
+                leader.followers.append(follower)
+                self.coalesced += 1
+        if leader is not None:
+            if metrics is not None:
+                metrics.increment('coalesced')
+            return follower
+
+        watch = query_stopwatch()
+        try:
+            certificate = get_certificate(self.certificate_cache, self.ip, self.port,
+                                          self.provider_key, self.provider_url, self.timeout)
+            (pk, nmkey) = self.key_manager.get(certificate.resolver_pk)
+            watch.reset()
+            message = build_query(name, rtype)
+            watch.lap('build')
+
+            with self._lock:
+                if self._closed:
+                    raise DnscryptException("Multiplexer is closed.")
+                if not self._connected:
+                    raise DnscryptException("Connection closed.")
+                nonce = make_nonce()
+                while nonce in self._pending:
+                    nonce = make_nonce()
+                pending = PendingQuery(name, rtype, nonce, nmkey, time.time() + self.timeout, notify)
+                pending.retry = (message, certificate.magic_query, pk)
+                pending.watch = watch
+                self._pending[nonce] = pending
+                self._in_flight.setdefault(key, pending)
+        except Exception as e:
+            watch.error(e)
+            raise
+
+        (request, nonce) = encrypt_query(message, certificate.magic_query, pk, nmkey, nonce)
+        watch.lap('encode')
+        watch.increment('bytes_sent', len(request))
+        try:
+            with self._send_lock:
+                watch.reset()  # the network phase lasts until the answer is dispatched
+                if not self._connected:
+                    self._finish(nonce, error=DnscryptException("Connection closed."))
+                elif self.tcp:
+                    self._sock.sendall(frame(request))
+                else:
+                    self._sock.send(request)
+        except socket.error as e:
+            self._finish(nonce, error=e)
+        return pending
+
+    def resolve(self, name, rtype=1):
+        return self.submit(name, rtype).result()
+
+    def resolve_many(self, names, rtype=1, concurrency=None):
+        '''Query names with at most concurrency queries in flight, yielding
+        (name, packet or exception) as the answers come in.'''
+        done = Queue.Queue()
+        names = iter(names)
+        exhausted = False
+        in_flight = 0
+        while True:
+            while not exhausted and (concurrency is None or in_flight < concurrency):
+                try:
+                    name = next(names)
+                except StopIteration:
+                    exhausted = True
+                    break
+                try:
+                    self.submit(name, rtype, done)
+                except (DnscryptException, socket.error) as e:
+                    yield name, e
+                    continue
+                in_flight += 1
+            if not in_flight:
+                return
+            pending = done.get()
+            in_flight -= 1
+            yield pending.name, pending._error or pending._packet
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending.values(), {}
+            self._in_flight.clear()
+        for query in pending:
+            query._complete(error=DnscryptException("Multiplexer is closed."))
+        self._receiver.join()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self):
+        if self.tcp:
+            sock = socket.create_connection((self.ip, self.port), self.timeout)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((self.ip, self.port))
+        sock.settimeout(self.TICK)
+        return sock
+
+    def _reconnect(self):
+        with self._lock:
+            failed, self._pending = self._pending.values(), {}
+            self._in_flight.clear()
+        with self._send_lock:
+            self._connected = False
+            self._sock.close()
+        for pending in failed:
+            pending._complete(error=DnscryptException("Connection closed."))
+
+        # submissions fail fast while the connection is down
+        delay = self.TICK
+        while not self._closed:
+            try:
+                sock = self._connect()
+            except socket.error:
+                time.sleep(delay)
+                delay = min(delay * 2, self.MAX_BACKOFF)
+                continue
+            with self._send_lock:
+                self._sock = sock
+                self._connected = True
+            return
+
+    def _receive_loop(self):
+        buffer = ''
+        next_expiry = time.time() + self.TICK
+        while not self._closed:
+            if time.time() >= next_expiry:
+                self._expire()
+                next_expiry = time.time() + self.TICK
+            try:
+                data = self._sock.recv(65535)
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self.tcp and not self._closed:
+                    self._reconnect()
+                    buffer = ''
+                continue
+
+            if not self.tcp:
+                self._dispatch(data)
+                continue
+            if not data:
+                if not self._closed:
+                    self._reconnect()
+                    buffer = ''
+                continue
+            buffer += data
+            while len(buffer) >= 2:
+                (length,) = struct.unpack('!H', buffer[:2])
+                if len(buffer) < 2 + length:
+                    break
+                self._dispatch(buffer[2:2 + length])
+                buffer = buffer[2 + length:]
+
+    def _dispatch(self, response):
+        with self._lock:
+            pending = self._pending.get(response[8:20])
+        if pending is None:
+            return  # an answer to an expired query
+        pending.watch.lap('network')
+        pending.watch.increment('bytes_received', len(response))
+        try:
+            decoded_answer = decrypt_response(response, pending.nonce, pending.nmkey)
+        except Exception as e:
+            self._finish(pending.nonce, error=e)
+            return
+        pending.watch.lap('decode')
+        if truncated(decoded_answer) and not self.tcp:
+            thread = threading.Thread(target=self._retry_tcp, args=(pending,))
+            thread.daemon = True
+            thread.start()
+            return
+        self._answer(pending, decoded_answer)
+
+    def _retry_tcp(self, pending):
+        (message, magic_query, pk) = pending.retry
+        try:
+            decoded_answer = query_tcp(self.ip, self.port, message, magic_query, pk,
+                                       pending.nmkey, self.timeout)
+        except Exception as e:
+            self._finish(pending.nonce, error=e)
+        else:
+            pending.watch.lap('network')
+            self._answer(pending, decoded_answer)
+
+    def _answer(self, pending, decoded_answer):
+        try:
+            packet = (self.answer_cache.add(pending.name, pending.rtype, decoded_answer)
+                      or DnsPacketConverter().fromBinary(decoded_answer))
+        except Exception as e:
+            self._finish(pending.nonce, error=e)
+        else:
+            pending.watch.lap('parse')
+            self._finish(pending.nonce, packet=packet)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [nonce for nonce, pending in self._pending.items() if pending.deadline < now]
+        for nonce in expired:
+            self._finish(nonce, error=DnscryptTimeout("Request timed out."))
+
+    def _finish(self, nonce, packet=None, error=None):
+        with self._lock:
+            pending = self._pending.pop(nonce, None)
+            if pending is not None:
+                key = (pending.name.lower().rstrip('.'), pending.rtype)
+                if self._in_flight.get(key) is pending:
+                    del self._in_flight[key]
+        if pending is not None:
+            if error is not None:
+                pending.watch.error(error)
+            pending._complete(packet, error)
+
+
+class ProxyConnection:
+    '''A TCP client of a DnscryptProxy.
+
+    Counts the queries read from it that are not answered yet. The socket
+    is closed once the client has stopped sending and all of them have been
+    answered, so a client may half-close after its last query.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.outstanding = 0
+        self.reading = True
+        self._lock = threading.Lock()  # also keeps answers from interleaving
+
+    def received(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def answer(self, answer):
+        '''Send answer, or nothing when it is None, for one outstanding query.'''
+        with self._lock:
+            if answer is not None:
+                try:
+                    self.sock.sendall(frame(answer))
+                except socket.error:
+                    pass
+            self.outstanding -= 1
+            self._close_if_done()
+
+    def stop_reading(self):
+        with self._lock:
+            self.reading = False
+            self._close_if_done()
+
+    def _close_if_done(self):
+        if not self.reading and not self.outstanding:
+            self.sock.close()
+
+
+class DnscryptProxy:
+    '''A local stub resolver forwarding plain DNS through one DNSCrypt session.
+
+    Listens for DNS over UDP and TCP on ip:port and answers each query
+    through resolver, so all local clients share its certificate, keys,
+    sockets and answer cache. Queries are handled by a pool of worker
+    threads, and failed lookups are answered with SERVFAIL. UDP answers
+    larger than the client's payload size are truncated so the client
+    retries over TCP.'''
+
+    UDP_PAYLOAD_SIZE = 512  # for clients without EDNS0
+    IDLE_TIMEOUT = 10.0  # seconds a TCP client with no queries outstanding may stay silent
+
+    def __init__(self, resolver, ip='127.0.0.1', port=53, workers=16):
+        self.resolver = resolver
+        self.workers = workers
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((ip, port))
+        (self.ip, self.port) = self.udp.getsockname()
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((self.ip, self.port))
+        self.tcp.listen(64)
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._running = False
+
+    def start(self):
+        self._running = True
+        targets = [self._serve_udp, self._serve_tcp] + [self._work] * self.workers
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._running = False
+        for sock in (self.udp, self.tcp):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        for i in range(self.workers):
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self._running:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def handle(self, data, tcp=False):
+        '''Return the answer to the plain DNS query data, or None to drop it.'''
+        converter = DnsPacketConverter()
+        try:
+            query = converter.fromBinary(data)
+            if query.header.bits & 0x8000 or query.header.qdCount != 1:
+                return self.error(data, 12, 1)  # FORMERR
+            (question, question_end) = converter.readQuestion(data, 12)
+        except DnscryptException:
+            return None
+        if question.qclass != 1:
+            return self.error(data, question_end, 4)  # NOTIMP
+
+        try:
+            answer = self.resolver.resolve('.'.join(question.labels), question.qtype,
+                                           return_packet=False)
+        except (DnscryptException, socket.error):
+            return self.error(data, question_end, 2)  # SERVFAIL
+
+        answer = data[:2] + answer[2:]
+        if not tcp and len(answer) > self.payload_size(query):
+            return self.truncate(answer)
+        return answer
+
+    def payload_size(self, query):
+        for record in query.additionalRecords:
+            if record.type == 41:  # OPT
+                return max(record.rrclass, self.UDP_PAYLOAD_SIZE)
+        return self.UDP_PAYLOAD_SIZE
+
+    def truncate(self, answer):
+        (question, question_end) = DnsPacketConverter().readQuestion(answer, 12)
+        (qid, bits) = struct.unpack('!HH', answer[:4])
+        return struct.pack('!HHHHHH', qid, bits | 0x0200, 1, 0, 0, 0) + answer[12:question_end]
+
+    def error(self, query, question_end, rcode):
+        (qid, bits) = struct.unpack('!HH', query[:4])
+        qdcount = 1 if question_end > 12 else 0
+        header = struct.pack('!HHHHHH', qid, 0x8080 | (bits & 0x7900) | rcode, qdcount, 0, 0, 0)
+        return header + query[12:question_end]
+
+    def _serve_udp(self):
+        while self._running:
+            try:
+                (data, address) = self.udp.recvfrom(65535)
+            except socket.error:
+                break
+            self._queue.put((data, address, None))
+
+    def _serve_tcp(self):
+        while self._running:
+            try:
+                (conn, address) = self.tcp.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self._serve_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve_connection(self, conn):
+        # queries on one connection are answered as they complete, possibly out of order
+        client = ProxyConnection(conn)
+        conn.settimeout(self.IDLE_TIMEOUT)  # for a client stalling inside a frame
+        try:
+            while self._running:
+                if not select.select([conn], [], [], self.IDLE_TIMEOUT)[0]:
+                    if client.outstanding:
+                        continue
+                    break
+                data = read_frame(conn)
+                client.received()
+                self._queue.put((data, None, client))
+        except (DnscryptException, socket.error, select.error):
+            pass
+        finally:
+            client.stop_reading()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            (data, address, client) = item
+            answer = self.handle(data, tcp=client is not None)
+            if client is not None:
+                client.answer(answer)
+                continue
+            if answer is None:
+                continue
+            try:
+                self.udp.sendto(answer, address)
+            except socket.error:
+                pass
 
-    conv = DnsPacketConverter()
-    packet = conv.fromBinary(decoded_answer)
-    return packet
 
+init_backend()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='DNSCrypt client.')
+    commands = parser.add_subparsers(dest='command')
+    proxy = commands.add_parser('proxy', help='serve plain DNS on loopback through a DNSCrypt resolver')
+    proxy.add_argument('--resolver-ip', required=True)
+    proxy.add_argument('--resolver-port', type=int, default=443)
+    proxy.add_argument('--provider-key', required=True)
+    proxy.add_argument('--provider-name', required=True)
+    proxy.add_argument('--ip', default='127.0.0.1')
+    proxy.add_argument('--port', type=int, default=53)
+    proxy.add_argument('--workers', type=int, default=16)
+    proxy.add_argument('--timeout', type=float, default=5.0)
+    proxy.add_argument('--prefetch', type=float, metavar='FRACTION',
+                       help='refresh popular answers past this fraction of their TTL')
+    proxy.add_argument('--store', metavar='PATH',
+                       help='keep certificates and answers in this sqlite file across restarts')
+    args = parser.parse_args()
+
+    store = PersistentStore(args.store) if args.store else None
+    answers = AnswerCache(store=store)
+    resolver = DnscryptResolver(args.resolver_ip, args.resolver_port, args.provider_key,
+                                args.provider_name, args.workers, args.timeout,
+                                CertificateCache(timeout=args.timeout, refresh_fraction=args.prefetch,
+                                                 store=store),
+                                key_manager, answers, args.prefetch)
+    answers.prefetcher = resolver.prefetcher
+    server = DnscryptProxy(resolver, args.ip, args.port, args.workers)
+    print 'Forwarding DNS on %s:%d to %s:%d' % (server.ip, server.port,
+                                                args.resolver_ip, args.resolver_port)
+    server.serve_forever()
+    resolver.close()
@@ -2,9 +2,10 @@
 
 import warnings
 import os
+import hashlib
 
 from collections import namedtuple
-import djbec
+from slownacl.curve25519 import P, D, D2, inv, edwards_add, edwards_base, base_table
 
 __all__ = ['crypto_sign', 'crypto_sign_open', 'crypto_sign_keypair', 'Keypair',
            'PUBLICKEYBYTES', 'SECRETKEYBYTES', 'SIGNATUREBYTES']
@@ -13,8 +14,96 @@ PUBLICKEYBYTES=32
 SECRETKEYBYTES=64
 SIGNATUREBYTES=64
 
+L = 2 ** 252 + 27742317777372353535851937790883648493
+I = pow(2, (P - 1) / 4, P)  # sqrt(-1)
+
 Keypair = namedtuple('Keypair', ('vk', 'sk')) # verifying key, secret key
 
+# Points are kept in extended twisted Edwards coordinates (X, Y, Z, T) with
+# x = X/Z, y = Y/Z and xy = T/Z. Base point multiples come from the table
+# in slownacl.curve25519.
+
+def double((x1, y1, z1, t1)):
+    a = x1 * x1 % P
+    b = y1 * y1 % P
+    c = 2 * z1 * z1 % P
+    h = a + b
+    e = h - (x1 + y1) ** 2
+    g = a - b
+    f = c + g
+    return (e * f % P, g * h % P, f * g % P, e * h % P)
+
+def add_cached((x1, y1, z1, t1), (ypx, ymx, z2, t2d)):
+    a = (y1 - x1) * ymx % P
+    b = (y1 + x1) * ypx % P
+    c = t1 * t2d % P
+    d = 2 * z1 * z2 % P
+    e, f, g, h = b - a, d - c, d + c, b + a
+    return (e * f % P, g * h % P, f * g % P, e * h % P)
+
+def cached((x, y, z, t)):
+    return ((y + x) % P, (y - x) % P, z, t * D2 % P)
+
+def double_scalarmult(s, h, a):
+    '''Return s * B + h * a for the base point B, sharing the doublings
+    between both scalars (Straus' method with 4-bit windows).'''
+    if not base_table:
+        edwards_base(0)  # builds the table
+    base_multiples = base_table[0]
+    multiples = [cached(a)]
+    point = a
+    for i in range(14):
+        point = add_cached(point, multiples[0])
+        multiples.append(cached(point))
+
+    point = (0, 1, 1, 0)
+    for i in range(63, -1, -1):
+        point = double(double(double(double(point))))
+        d = (h >> (4 * i)) & 15
+        if d:
+            point = add_cached(point, multiples[d - 1])
+        d = (s >> (4 * i)) & 15
+        if d:
+            point = edwards_add(point, base_multiples[d - 1])
+    return point
+
+def encodeint(n):
+    return ('%064x' % n).decode('hex')[::-1]
+
+def decodeint(s):
+    return int(s[::-1].encode('hex'), 16)
+
+def encodepoint((x, y, z, t)):
+    zi = inv(z)
+    x, y = x * zi % P, y * zi % P
+    return encodeint(y | (x & 1) << 255)
+
+def decodepoint(s):
+    n = decodeint(s)
+    y = n & ((1 << 255) - 1)
+    if y >= P:
+        raise ValueError("Invalid point encoding")
+    xx = (y * y - 1) * inv(D * y * y + 1) % P
+    x = pow(xx, (P + 3) / 8, P)
+    if (x * x - xx) % P != 0:
+        x = x * I % P
+    if (x * x - xx) % P != 0:
+        raise ValueError("Point is not on the curve")
+    if x == 0 and n >> 255:
+        raise ValueError("Invalid point encoding")
+    if x & 1 != n >> 255:
+        x = P - x
+    return (x, y, 1, x * y % P)
+
+def hint(m):
+    return decodeint(hashlib.sha512(m).digest()) % L
+
+def secret_scalar(h):
+    a = decodeint(h[:32])
+    a &= (1 << 254) - 8
+    a |= 1 << 254
+    return a
+
 def crypto_sign_keypair(seed=None):
     """Return (verifying, secret) key from a given seed, or os.urandom(32)"""
     if seed is None:
@@ -25,7 +114,7 @@ def crypto_sign_keypair(seed=None):
     if len(seed) != 32:
         raise ValueError("seed must be 32 random bytes or None.")
     skbytes = seed
-    vkbytes = djbec.publickey(skbytes)
+    vkbytes = encodepoint(edwards_base(secret_scalar(hashlib.sha512(skbytes).digest())))
     return Keypair(vkbytes, skbytes+vkbytes)
 
 
@@ -37,16 +126,41 @@ def crypto_sign(msg, sk):
         raise ValueError("Bad signing key length %d" % len(sk))
     vkbytes = sk[PUBLICKEYBYTES:]
     skbytes = sk[:PUBLICKEYBYTES]
-    sig = djbec.signature(msg, skbytes, vkbytes)
-    return sig + msg
+    h = hashlib.sha512(skbytes).digest()
+    r = hint(h[32:] + msg)
+    rbytes = encodepoint(edwards_base(r))
+    s = (r + hint(rbytes + vkbytes + msg) * secret_scalar(h)) % L
+    return rbytes + encodeint(s) + msg
 
 
+# Verified (signed, vk) pairs, keyed by their hash, so that re-fetching an
+# unchanged certificate does not repeat the point arithmetic.
+verified = {}
+MAX_VERIFIED = 256
+
 def crypto_sign_open(signed, vk):
     """Return message given signature+message and the verifying key."""
     if len(vk) != PUBLICKEYBYTES:
         raise ValueError("Bad verifying key length %d" % len(vk))
-    rc = djbec.checkvalid(signed[:SIGNATUREBYTES], signed[SIGNATUREBYTES:], vk)
-    if not rc:
-        raise ValueError("rc != True", rc)
-    return signed[SIGNATUREBYTES:]
+    if len(signed) < SIGNATUREBYTES:
+        raise ValueError("Signed message too short")
 
+    key = hashlib.sha256(vk + signed).digest()
+    if key in verified:
+        return signed[SIGNATUREBYTES:]
+
+    rbytes = signed[:32]
+    s = decodeint(signed[32:SIGNATUREBYTES])
+    if s >= L:
+        raise ValueError("Invalid signature")
+    (x, y, z, t) = decodepoint(vk)
+    h = hint(rbytes + vk + signed[SIGNATUREBYTES:])
+
+    # s * B == R + h * A, checked as s * B + h * (-A) == R
+    if encodepoint(double_scalarmult(s, h, (P - x, y, z, P - t))) != rbytes:
+        raise ValueError("Invalid signature")
+
+    if len(verified) >= MAX_VERIFIED:
+        verified.clear()
+    verified[key] = True
+    return signed[SIGNATUREBYTES:]
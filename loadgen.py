@@ -0,0 +1,207 @@
+# Copyright (c) 2014-2015, The Monero Project
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be
+#    used to endorse or promote products derived from this software without specific
+#    prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''Drives the blocking, threaded and multiplexed clients against a DNSCrypt
+server and reports queries per second and latency percentiles. Without
+--ip it starts a local testserver on loopback, so no network is needed:
+
+    python loadgen.py [--mode blocking|threaded|multiplexed] [--duration 5]
+
+Each thread or in-flight slot queries its own name, 0.<name>, 1.<name>
+and so on, so concurrent queries are never coalesced into one upstream
+query. The local testserver serves the records of <name> under each of
+them; a remote server has to answer for them too.
+'''
+
+import argparse
+import json
+import Queue
+import threading
+import time
+
+import dnscrypt
+import testserver
+
+DEFAULT_ZONE = '''
+donate.getmonero.org 300 TXT "oa1:xmr recipient_address=46BeWrHpwXmHDpDEUmZBWZfoQpdc6HaERCNmx1pEYL2rAcuwufPN9rXHHtyUA4QVy66qeFQkn6sfK8aHYjA3jk3o1Bv16em; recipient_name=Monero Development;"
+'''
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, error=False):
+        with self._lock:
+            if error:
+                self.errors += 1
+            else:
+                self.latencies.append(latency)
+
+    def report(self, mode, elapsed):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+        return {'mode': mode, 'queries': len(latencies), 'errors': self.errors,
+                'seconds': elapsed, 'qps': len(latencies) / elapsed,
+                'p50_ms': percentile(0.50), 'p99_ms': percentile(0.99),
+                'p999_ms': percentile(0.999)}
+
+
+def run_blocking(target, args, stats, deadline):
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            dnscrypt.query(args.name, target['ip'], target['port'], target['provider_key'],
+                           target['provider_name'], args.qtype)
+        except dnscrypt.DnscryptException:
+            stats.record(time.time() - start, error=True)
+        else:
+            stats.record(time.time() - start)
+
+
+def run_threaded(target, args, stats, deadline):
+    resolver = dnscrypt.DnscryptResolver(target['ip'], target['port'], target['provider_key'],
+                                         target['provider_name'], pool_size=args.threads,
+                                         answer_cache=uncached())
+
+    def worker(name):
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                resolver.resolve(name, args.qtype)
+            except dnscrypt.DnscryptException:
+                stats.record(time.time() - start, error=True)
+            else:
+                stats.record(time.time() - start)
+
+    threads = [threading.Thread(target=worker, args=(name,))
+               for name in query_names(args.name, args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    resolver.close()
+
+
+def run_multiplexed(target, args, stats, deadline):
+    multiplexer = dnscrypt.DnscryptMultiplexer(target['ip'], target['port'], target['provider_key'],
+                                               target['provider_name'], answer_cache=uncached())
+    done = Queue.Queue()
+    started = {}
+    idle = query_names(args.name, args.concurrency)  # names not in flight
+    while True:
+        while idle and time.time() < deadline:
+            pending = multiplexer.submit(idle.pop(), args.qtype, done)
+            started[pending] = time.time()
+        if not started:
+            break
+        pending = done.get()
+        idle.append(pending.name)
+        stats.record(time.time() - started.pop(pending), error=pending._error is not None)
+    multiplexer.close()
+
+
+MODES = {'blocking': run_blocking, 'threaded': run_threaded, 'multiplexed': run_multiplexed}
+
+
+def query_names(name, count):
+    return ['%d.%s' % (i, name) for i in range(count)]
+
+
+def serve_names(zone, name, count):
+    '''Copy the records of name to each of query_names(name, count).'''
+    name = name.lower().rstrip('.')
+    for ((owner, rtype), records) in zone.items():
+        if owner == name:
+            for alias in query_names(name, count):
+                zone[(alias, rtype)] = records
+
+
+def uncached():
+    return dnscrypt.AnswerCache(max_ttl=0)  # answers are never stored
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DNSCrypt load generator.')
+    parser.add_argument('--mode', action='append', choices=sorted(MODES),
+                        help='client path to drive, may be repeated (default: all)')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per mode')
+    parser.add_argument('--threads', type=int, default=8, help='threads for the threaded mode')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='queries in flight for the multiplexed mode')
+    parser.add_argument('--name', default='donate.getmonero.org')
+    parser.add_argument('--qtype', type=int, default=16)
+    parser.add_argument('--zone', help='zone file for the local test server')
+    parser.add_argument('--ip', help='use this DNSCrypt server instead of a local one')
+    parser.add_argument('--port', type=int, default=443)
+    parser.add_argument('--provider-key')
+    parser.add_argument('--provider-name')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    server = None
+    if args.ip:
+        target = {'ip': args.ip, 'port': args.port, 'provider_key': args.provider_key,
+                  'provider_name': args.provider_name}
+    else:
+        zone = testserver.load_zone(args.zone) if args.zone else testserver.parse_zone(DEFAULT_ZONE)
+        serve_names(zone, args.name, max(args.threads, args.concurrency))
+        server = testserver.DnscryptTestServer(zone).start()
+        target = {'ip': server.ip, 'port': server.port, 'provider_key': server.provider_key,
+                  'provider_name': server.provider_name}
+
+    dnscrypt.answer_cache = uncached()
+    reports = []
+    for mode in args.mode or ['blocking', 'threaded', 'multiplexed']:
+        stats = Stats()
+        start = time.time()
+        MODES[mode](target, args, stats, start + args.duration)
+        reports.append(stats.report(mode, time.time() - start))
+
+    if server is not None:
+        server.stop()
+
+    if args.json:
+        print json.dumps(reports, indent=2, sort_keys=True)
+        return
+    print '%-12s %8s %7s %9s %9s %9s %9s' % ('mode', 'queries', 'errors', 'qps', 'p50 ms', 'p99 ms', 'p999 ms')
+    for r in reports:
+        print '%-12s %8d %7d %9.1f %9.2f %9.2f %9.2f' % (
+            r['mode'], r['queries'], r['errors'], r['qps'],
+            r['p50_ms'] or 0, r['p99_ms'] or 0, r['p999_ms'] or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,49 +2,103 @@ __all__ = ['smult_curve25519_base', 'smult_curve25519']
 
 P = 2 ** 255 - 19
 A = 486662
-
-def expmod(b, e, m):
-  if e == 0: return 1
-  t = expmod(b, e / 2, m) ** 2 % m
-  if e & 1: t = (t * b) % m
-  return t
+A24 = (A - 2) / 4
 
 def inv(x):
-  return expmod(x, P - 2, P)
+  return pow(x, P - 2, P)
 
-# Addition and doubling formulas taken from Appendix D of "Curve25519:
-# new Diffie-Hellman speed records".
+# Montgomery ladder with the doubling and differential addition formulas
+# of RFC 7748, section 5. Every bit of n costs one doubling and one
+# addition, but the working points are swapped with a branch on the key
+# bit, and Python integers are not constant time in any case (see README).
 
-def add((xn,zn), (xm,zm), (xd,zd)):
-  x = 4 * (xm * xn - zm * zn) ** 2 * zd
-  z = 4 * (xm * zn - zm * xn) ** 2 * xd
-  return (x % P, z % P)
+def curve25519(n, base):
+  x2, z2 = 1, 0
+  x3, z3 = base, 1
+  swap = 0
+  for t in xrange(254, -1, -1):
+    bit = (n >> t) & 1
+    if swap ^ bit:
+      x2, x3, z2, z3 = x3, x2, z3, z2
+    swap = bit
+    a = x2 + z2
+    aa = a * a % P
+    b = x2 - z2
+    bb = b * b % P
+    e = aa - bb
+    c = x3 + z3
+    d = x3 - z3
+    da = d * a % P
+    cb = c * b % P
+    x3 = (da + cb) ** 2 % P
+    z3 = base * (da - cb) ** 2 % P
+    x2 = aa * bb % P
+    z2 = e * (aa + A24 * e) % P
+  if swap:
+    x2, z2 = x3, z3
+  return x2 * inv(z2) % P
 
-def double((xn,zn)):
-  x = (xn ** 2 - zn ** 2) ** 2
-  z = 4 * xn * zn * (xn ** 2 + A * xn * zn + zn ** 2)
-  return (x % P, z % P)
+# The base point 9 corresponds to the Ed25519 base point on the
+# birationally equivalent twisted Edwards curve, u = (1 + y) / (1 - y).
+# Fixed-base multiplication uses a table holding d * 16^i * B for every
+# 4-bit window i and digit d, so n * B is at most 64 table additions, as
+# zero digits are skipped, and one inversion. The table is built on first
+# use.
 
-def curve25519(n, base):
-  one = (base,1)
-  two = double(one)
-  # f(m) evaluates to a tuple containing the mth multiple and the
-  # (m+1)th multiple of base.
-  def f(m):
-    if m == 1: return (one, two)
-    (pm, pm1) = f(m / 2)
-    if (m & 1):
-      return (add(pm, pm1, one), double(pm1))
-    return (double(pm), add(pm, pm1, one))
-  ((x,z), _) = f(n)
-  return (x * inv(z)) % P
+D = -121665 * inv(121666) % P
+D2 = 2 * D % P
+BY = 4 * inv(5) % P
+BX = 15112221349535400772501151409588531511454012693041857206046113283949847762202
+
+def edwards_add((x1, y1, z1, t1), (ypx, ymx, xy2d)):
+  # extended coordinates plus a precomputed affine point (y+x, y-x, 2dxy)
+  a = (y1 - x1) * ymx % P
+  b = (y1 + x1) * ypx % P
+  c = t1 * xy2d % P
+  d = 2 * z1
+  e, f, g, h = b - a, d - c, d + c, b + a
+  return (e * f % P, g * h % P, f * g % P, e * h % P)
+
+def edwards_precompute((x, y, z, t)):
+  zi = inv(z)
+  x, y = x * zi % P, y * zi % P
+  return ((y + x) % P, (y - x) % P, x * y * D2 % P)
+
+base_table = []
+
+def build_base_table():
+  table = []
+  point = (BX, BY, 1, BX * BY % P)
+  for i in range(64):
+    row = [edwards_precompute(point)]
+    multiple = point
+    for d in range(2, 17):
+      multiple = edwards_add(multiple, row[0])
+      row.append(edwards_precompute(multiple))
+    table.append(row[:15])
+    point = multiple  # 16 * point
+  return table
+
+def edwards_base(n):
+  if not base_table:
+    base_table.extend(build_base_table())
+  point = (0, 1, 1, 0)
+  for i in range(64):
+    d = (n >> (4 * i)) & 15
+    if d:
+      point = edwards_add(point, base_table[i][d - 1])
+  return point
+
+def curve25519_base(n):
+  (x, y, z, t) = edwards_base(n)
+  return (z + y) * inv(z - y) % P
 
 def unpack(s):
   if len(s) != 32: raise ValueError('Invalid Curve25519 argument')
-  return sum(ord(s[i]) << (8 * i) for i in range(32))
+  return int(s[::-1].encode('hex'), 16)
 
 def pack(n):
-  return ''.join([chr((n >> (8 * i)) & 255) for i in range(32)])
+  return ('%064x' % n).decode('hex')[::-1]
 
 def clamp(n):
   n &= ~7
@@ -59,4 +113,4 @@ def smult_curve25519(n, p):
 
 def smult_curve25519_base(n):
   n = clamp(unpack(n))
-  return pack(curve25519(n, 9))
+  return pack(curve25519_base(n))
@@ -1,26 +1,32 @@
+import struct
 from verify import verify16
 
 __all__ = ['onetimeauth_poly1305', 'onetimeauth_poly1305_verify']
 
 P = 2 ** 130 - 5
+BLOCK = struct.Struct('<QQ')
 
 def limb(s):
   return unpack(s) + (1 << 8 * len(s))
 
 def unpack(s):
-  return sum(ord(s[i]) << 8 * i for i in range(len(s)))
+  return int(s[::-1].encode('hex') or '0', 16)
 
 def pack(n):
-  return ''.join([chr(n >> 8 * i & 255) for i in range(16)])
+  return ('%032x' % (n & 0xffffffffffffffffffffffffffffffff)).decode('hex')[::-1]
 
 def onetimeauth_poly1305(m, k):
   if len(k) != 32: raise ValueError('Invalid Poly1305 key')
   r = unpack(k[:16]) & 0x0ffffffc0ffffffc0ffffffc0fffffff
 
+  # full 16-byte blocks are read as two little-endian 64-bit words in place
   h = 0
-  for i in range(0, len(m), 16):
-    c = limb(m[i:i+16])
-    h = (h + c) * r % P
+  full = len(m) - len(m) % 16
+  for i in range(0, full, 16):
+    (lo, hi) = BLOCK.unpack_from(m, i)
+    h = (h + (hi << 64 | lo) + (1 << 128)) * r % P
+  if full < len(m):
+    h = (h + limb(m[full:])) * r % P
   h += unpack(k[16:])
 
   return pack(h)
@@ -0,0 +1,147 @@
+import itertools
+import multiprocessing
+import threading
+import Queue
+from xsalsa20poly1305 import box_curve25519xsalsa20poly1305_keypair, box_curve25519xsalsa20poly1305_beforenm, box_curve25519xsalsa20poly1305_afternm, box_curve25519xsalsa20poly1305_open_afternm
+
+__all__ = ['CryptoPool', 'PoolError', 'PoolTimeout']
+
+OPERATIONS = {
+  'keypair': box_curve25519xsalsa20poly1305_keypair,
+  'beforenm': box_curve25519xsalsa20poly1305_beforenm,
+  'afternm': box_curve25519xsalsa20poly1305_afternm,
+  'open_afternm': box_curve25519xsalsa20poly1305_open_afternm,
+}
+
+def run_batch(batch):
+  # runs in a worker process; errors are returned, as a raised one would
+  # fail the whole batch
+  results = []
+  for (name, args) in batch:
+    try:
+      results.append((True, OPERATIONS[name](*args)))
+    except Exception as e:
+      results.append((False, str(e)))
+  return results
+
+
+class PoolError(Exception):
+  '''The pool is closed, so the call was not run.'''
+
+class PoolTimeout(PoolError):
+  '''The call was not answered within the pool's timeout.'''
+
+CLOSED = (None, 'Crypto pool is closed')  # result of calls failed by close()
+
+
+class CryptoPool(object):
+  '''Runs box operations in a pool of worker processes, outside the GIL.
+
+  Calls block their thread until the result is back. A dispatcher thread
+  takes whatever calls are waiting, up to batch_size per process, and
+  sends them to the workers in one batch per process. Failures raise
+  ValueError, like the functions in xsalsa20poly1305. Calls not answered
+  within timeout seconds, as when a worker dies, raise PoolTimeout, and
+  close() fails the calls still waiting, and any made later, with
+  PoolError. The processes are started on first use.'''
+
+  def __init__(self, processes=None, batch_size=16, timeout=10.0):
+    self.processes = processes or multiprocessing.cpu_count()
+    self.batch_size = batch_size
+    self.timeout = timeout
+    self._pool = None
+    self._closed = False
+    self._queue = Queue.Queue()
+    self._lock = threading.Lock()
+    self._sent = {}  # batch number -> calls sent to the workers and not answered yet
+    self._sent_lock = threading.Lock()
+    self._numbers = itertools.count()
+
+  def box_keypair(self):
+    return self.call('keypair')
+
+  def box_beforenm(self, pk, sk):
+    return self.call('beforenm', pk, sk)
+
+  def box_afternm(self, m, n, k):
+    return self.call('afternm', m, n, k)
+
+  def box_open_afternm(self, c, n, k):
+    return self.call('open_afternm', c, n, k)
+
+  def call(self, name, *args):
+    self._start()
+    pending = [threading.Event(), None]
+    with self._lock:  # so the call is queued ahead of close()'s stop marker, or not at all
+      if self._closed: raise PoolError(CLOSED[1])
+      self._queue.put(((name, args), pending))
+    if not pending[0].wait(self.timeout):
+      raise PoolTimeout('Crypto pool timed out')
+    (ok, result) = pending[1]
+    if ok is None: raise PoolError(result)
+    if not ok: raise ValueError(result)
+    return result
+
+  def close(self):
+    with self._lock:
+      self._closed = True
+      if self._pool is None: return
+      pool = self._pool
+      with self._sent_lock:
+        self._pool = None
+        batches = self._sent.values()  # terminated workers never call back
+        self._sent.clear()
+      self._queue.put(None)
+    for batch in batches:
+      self._deliver(batch, [CLOSED] * len(batch))
+    # terminate() hangs if a worker was killed holding the task queue lock
+    thread = threading.Thread(target=pool.terminate)
+    thread.daemon = True
+    thread.start()
+
+  def _start(self):
+    if self._pool is not None: return
+    with self._lock:
+      if self._closed: raise PoolError(CLOSED[1])
+      if self._pool is not None: return
+      self._pool = multiprocessing.Pool(self.processes)
+      thread = threading.Thread(target=self._dispatch, args=(self._pool,))
+      thread.daemon = True
+      thread.start()
+
+  def _dispatch(self, pool):
+    while True:
+      calls = [self._queue.get()]
+      while len(calls) < self.batch_size * self.processes:
+        try:
+          calls.append(self._queue.get_nowait())
+        except Queue.Empty:
+          break
+      if None in calls:
+        self._deliver([call for call in calls if call is not None],
+                      [CLOSED] * len(calls))
+        return
+      # one batch per process, so a burst of calls uses every core
+      size = -(-len(calls) // self.processes)
+      for i in range(0, len(calls), size):
+        batch = calls[i:i + size]
+        number = next(self._numbers)
+        with self._sent_lock:
+          closed = self._pool is not pool  # since the calls were taken
+          if not closed:
+            self._sent[number] = batch
+            pool.apply_async(run_batch, ([operation for (operation, pending) in batch],),
+                             callback=lambda results, number=number: self._answer(number, results))
+        if closed:
+          self._deliver(batch, [CLOSED] * len(batch))
+
+  def _answer(self, number, results):
+    with self._sent_lock:
+      batch = self._sent.pop(number, None)
+    if batch is not None:
+      self._deliver(batch, results)
+
+  def _deliver(self, batch, results):
+    for ((operation, pending), result) in zip(batch, results):
+      pending[1] = result
+      pending[0].set()
@@ -1,6 +1,11 @@
 import struct
 from util import xor
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 __all__ = ['core_hsalsa20', 'stream_salsa20', 'stream_salsa20_xor', 'stream_xsalsa20', 'stream_xsalsa20_xor']
 
 def rotate(x, n):
@@ -65,12 +70,54 @@ def core_hsalsa20(n, k):
   k = struct.unpack('<8I', k)
   return hblock(n, k)
 
+# With NumPy, streams of at least NUMPY_MIN_BLOCKS blocks compute all their
+# blocks at once: word i of every block lives in one uint32 array, so each
+# step below is a single vectorized operation over all the blocks. Shorter
+# streams are faster without NumPy's per-operation overhead.
+USE_NUMPY = numpy is not None
+NUMPY_MIN_BLOCKS = 16
+
+def vstep(x, i, j, k, r):
+  t = x[j] + x[k]
+  x[i] ^= (t << r) | (t >> (32 - r))
+
+def vquarterround(x, i0, i1, i2, i3):
+  vstep(x, i1, i0, i3, 7)
+  vstep(x, i2, i1, i0, 9)
+  vstep(x, i3, i2, i1, 13)
+  vstep(x, i0, i3, i2, 18)
+
+def vblocks(n, k, count):
+  counter = numpy.arange(count, dtype=numpy.uint64)
+  s = numpy.empty((16, count), dtype=numpy.uint32)
+  s[::5] = numpy.array(o, dtype=numpy.uint32)[:, None]
+  s[1:5] = numpy.array(k[:4], dtype=numpy.uint32)[:, None]
+  s[6:8] = numpy.array(n, dtype=numpy.uint32)[:, None]
+  s[8] = counter & 0xffffffff
+  s[9] = counter >> 32
+  s[11:15] = numpy.array(k[4:], dtype=numpy.uint32)[:, None]
+  x = list(s.copy())
+  for i in range(10):
+    vquarterround(x, 0, 4, 8, 12)
+    vquarterround(x, 5, 9, 13, 1)
+    vquarterround(x, 10, 14, 2, 6)
+    vquarterround(x, 15, 3, 7, 11)
+    vquarterround(x, 0, 1, 2, 3)
+    vquarterround(x, 5, 6, 7, 4)
+    vquarterround(x, 10, 11, 8, 9)
+    vquarterround(x, 15, 12, 13, 14)
+  x = numpy.array(x) + s
+  return x.T.astype('<u4').tostring()
+
 def stream_salsa20(l, n, k):
   output = []
   n = struct.unpack('<2I', n)
   k = struct.unpack('<8I', k)
+  count = (l + 63) / 64
+  if USE_NUMPY and count >= NUMPY_MIN_BLOCKS:
+    return vblocks(n, k, count)[:l]
   n = list(n) + [0, 0]
-  for i in xrange(0, (l + 63) / 64):
+  for i in xrange(0, count):
     n[2], n[3] = i & 0xffffffff, i >> 32
     output.append(block(n, k))
   return ''.join(output)[:l]
@@ -82,4 +129,4 @@ def stream_xsalsa20(l, n, k):
   return stream_salsa20(l, n[16:], core_hsalsa20(n[:16], k))
 
 def stream_xsalsa20_xor(m, n, k):
-  return xor(m, stream_xsalsa20_xor(len(m), n, k))
+  return xor(m, stream_xsalsa20(len(m), n, k))
@@ -0,0 +1,66 @@
+# This is not part of the slownacl library, it's a check of the DNS message
+# parser in dnscrypt.py on responses that use name compression.
+
+import struct
+import dnscrypt
+
+def name(*labels):
+  return ''.join(chr(len(l)) + l for l in labels)
+
+def record(owner, rtype, rdata, ttl=300):
+  return owner + struct.pack('!HHiH', rtype, 1, ttl, len(rdata)) + rdata
+
+def response(question, records):
+  header = struct.pack('!HHHHHH', 0x1234, 0x8180, 1, len(records), 0, 0)
+  return header + question + struct.pack('!HH', 5, 1) + ''.join(records)
+
+def check_compressed():
+  # www.example.com at offset 12; the CNAME target is mail + a pointer to
+  # example.com inside it, and the second record's owner points at that
+  question = name('www', 'example', 'com') + '\x00'
+  cname = '\x04mail\xc0\x10'
+  first = record('\xc0\x0c', 5, cname)
+  target = 12 + len(question) + 4 + len(first) - len(cname)
+  second = record(struct.pack('!H', 0xc000 | target), 1, '\x7f\x00\x00\x01')
+  packet = dnscrypt.DnsPacketConverter().fromBinary(response(question, [first, second]))
+  if packet.questions[0].labels != ['www', 'example', 'com']: return False
+  (a, b) = packet.answerRecords
+  if a.name != ['www', 'example', 'com'] or a.value != 'mail.example.com': return False
+  if b.name != ['mail', 'example', 'com'] or b.value != '127.0.0.1': return False
+  return True
+
+def check_bad_pointers():
+  question = name('www', 'example', 'com') + '\x00'
+  for owner in ['\xc0\x40',        # points forwards, past the end
+                '\xc0\x21',        # points at itself
+                '\x80\x0c']:       # reserved label type
+    message = response(question, [record(owner, 1, '\x7f\x00\x00\x01')])
+    try:
+      packet = dnscrypt.DnsPacketConverter().fromBinary(message)
+      packet.answerRecords[0].name
+    except dnscrypt.DnscryptException:
+      continue
+    return False
+  return True
+
+def check_overlong_strings():
+  # a TXT string whose length byte runs past the end of its rdata
+  question = name('www', 'example', 'com') + '\x00'
+  message = response(question, [record('\xc0\x0c', 16, '\x02hi\x09overrun')])
+  try:
+    dnscrypt.DnsPacketConverter().fromBinary(message).answerRecords[0].value
+  except dnscrypt.DnscryptException:
+    return True
+  return False
+
+def check(name, f):
+  print ('Checking %s...' % name),
+  ok = f()
+  print 'ok' if ok else 'FAILED'
+  return ok
+
+if __name__ == '__main__':
+  results = [check('compressed names', check_compressed),
+             check('bad compression pointers', check_bad_pointers),
+             check('overlong TXT strings', check_overlong_strings)]
+  raise SystemExit(0 if all(results) else 1)
@@ -0,0 +1,63 @@
+# This is not part of the slownacl library, it's a check of ed25519py, which
+# builds on slownacl.curve25519, against the RFC 8032 test vectors.
+
+import warnings
+import ed25519py
+
+# (secret key, public key, message, signature) from RFC 8032, section 7.1
+VECTORS = [
+  ('9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60',
+   'd75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a',
+   '',
+   'e5564300c360ac729086e2cc806e828a84877f1eb8e5d974d873e065224901555fb8821590a33bacc61e39701cf9b46bd25bf5f0595bbe24655141438e7a100b'),
+  ('4ccd089b28ff96da9db6c346ec114e0f5b8a319f35aba624da8cf6ed4fb8a6fb',
+   '3d4017c3e843895a92b70aa74d1b7ebc9c982ccf2ec4968cc0cd55f12af4660c',
+   '72',
+   '92a009a9f0d4cab8720e820b5f642540a2b27b5416503f8fb3762223ebdb69da085ac1e43e15996e458f3613d0f11d8c387b2eaeb4302aeeb00d291612bb0c00'),
+  ('c5aa8df43f9f837bedb7442f31dcb7b166d38535076f094b85ce3a2e0b4458f7',
+   'fc51cd8e6218a1a38da47ed00230f0580816ed13ba3303ac5deb911548908025',
+   'af82',
+   '6291d657deec24024827e69c3abe01a30ce548a284743a445e3680d7db5ac3ac18ff9b538d16f290ae67f760984dc6594a7c15e9716ed28dc027beceea1ec40a'),
+]
+
+def flip(s, i):
+  return s[:i] + chr(ord(s[i]) ^ 1) + s[i + 1:]
+
+def rejects(signed, vk):
+  try:
+    ed25519py.crypto_sign_open(signed, vk)
+  except ValueError:
+    return True
+  return False
+
+def check_vectors():
+  for (sk, pk, msg, sig) in VECTORS:
+    (sk, pk, msg, sig) = (sk.decode('hex'), pk.decode('hex'), msg.decode('hex'), sig.decode('hex'))
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')
+      keypair = ed25519py.crypto_sign_keypair(sk)
+    if keypair.vk != pk: return False
+    if ed25519py.crypto_sign(msg, keypair.sk) != sig + msg: return False
+    if ed25519py.crypto_sign_open(sig + msg, pk) != msg: return False
+  return True
+
+def check_tampered():
+  for (sk, pk, msg, sig) in VECTORS:
+    (pk, signed) = (pk.decode('hex'), (sig + msg).decode('hex'))
+    ed25519py.crypto_sign_open(signed, pk)  # a verified copy is memoized
+    for i in [0, 31, 32, 63] + range(64, len(signed)):
+      if not rejects(flip(signed, i), pk): return False
+    if not rejects(signed, flip(pk, 0)): return False
+    if not rejects(signed + 'x', pk): return False
+  return True
+
+def check(name, f):
+  print ('Checking %s...' % name),
+  ok = f()
+  print 'ok' if ok else 'FAILED'
+  return ok
+
+if __name__ == '__main__':
+  results = [check('RFC 8032 vectors', check_vectors),
+             check('tampered signatures', check_tampered)]
+  raise SystemExit(0 if all(results) else 1)
@@ -0,0 +1,76 @@
+# This is not part of the slownacl library, it's a check of the TCP side of
+# the DnscryptProxy in dnscrypt.py against a local testserver.
+
+import socket
+import struct
+import dnscrypt
+import testserver
+
+def query(qid, name):
+  return (struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0) +
+          testserver.encode_name(name) + struct.pack('!HH', 1, 1))
+
+def check_half_close(proxy):
+  # queries sent just before the client shuts down its side are still answered
+  client = socket.create_connection((proxy.ip, proxy.port))
+  client.settimeout(5)
+  try:
+    for qid in (1, 2):
+      client.sendall(dnscrypt.frame(query(qid, 'www.example.com')))
+    client.shutdown(socket.SHUT_WR)
+    ids = set()
+    for i in range(2):
+      packet = dnscrypt.DnsPacketConverter().fromBinary(dnscrypt.read_frame(client))
+      if packet.answers != ['\x7f\x00\x00\x01']: return False
+      ids.add(packet.header.id)
+    return ids == set([1, 2]) and client.recv(1) == ''
+  except (dnscrypt.DnscryptException, socket.error):
+    return False
+  finally:
+    client.close()
+
+def check_unpadded(proxy, server):
+  # the resolver's padding is stripped before answers reach the client
+  message = query(3, 'www.example.com')
+  client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  client.settimeout(5)
+  try:
+    client.sendto(message, (proxy.ip, proxy.port))
+    return client.recv(4096) == server.answer(message)
+  except socket.error:
+    return False
+  finally:
+    client.close()
+
+def check_idle(proxy):
+  # a client with nothing outstanding is dropped after IDLE_TIMEOUT
+  client = socket.create_connection((proxy.ip, proxy.port))
+  client.settimeout(5)
+  try:
+    return client.recv(1) == ''
+  except socket.error:
+    return False
+  finally:
+    client.close()
+
+def check(name, f, *args):
+  print ('Checking %s...' % name),
+  ok = f(*args)
+  print 'ok' if ok else 'FAILED'
+  return ok
+
+if __name__ == '__main__':
+  server = testserver.DnscryptTestServer(testserver.parse_zone('www.example.com 300 A 127.0.0.1')).start()
+  resolver = dnscrypt.DnscryptResolver(server.ip, server.port, server.provider_key, server.provider_name)
+  proxy = dnscrypt.DnscryptProxy(resolver, port=0, workers=2)
+  proxy.IDLE_TIMEOUT = 0.5
+  proxy.start()
+  try:
+    results = [check('answers after a half-close', check_half_close, proxy),
+               check('unpadded answers', check_unpadded, proxy, server),
+               check('idle connections', check_idle, proxy)]
+  finally:
+    proxy.stop()
+    resolver.close()
+    server.stop()
+  raise SystemExit(0 if all(results) else 1)
@@ -1,11 +1,11 @@
 __all__ = ['xor', 'randombytes']
 
 def xor(s, t):
-  output = []
   if len(s) != len(t): raise ValueError('Cannot xor strings of unequal length')
-  for i in range(len(s)):
-    output.append(chr(ord(s[i]) ^ ord(t[i])))
-  return ''.join(output)
+  if not s: return ''
+  # xor both strings as single big integers rather than byte by byte
+  x = int(s.encode('hex'), 16) ^ int(t.encode('hex'), 16)
+  return ('%0*x' % (2 * len(s), x)).decode('hex')
 
 def randombytes(n):
   return open('/dev/urandom').read(n)
@@ -0,0 +1,265 @@
+# Copyright (c) 2014-2015, The Monero Project
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be
+#    used to endorse or promote products derived from this software without specific
+#    prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL
+# THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+# THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''A minimal DNSCrypt v1 server for local testing.
+
+It serves a signed certificate on the provider name and answers encrypted
+queries from a small zone file, over UDP and over TCP on the same port.
+UDP answers larger than the payload size the client advertised are sent
+truncated. It is meant for loopback testing and load generation, not for
+real use.
+
+Zone files hold one record per line, "name ttl type data", for example:
+
+    donate.getmonero.org 300 TXT "oa1:xmr recipient_address=46Be...;"
+    example.com 60 A 192.0.2.1
+'''
+
+import os
+import shlex
+import socket
+import struct
+import threading
+import time
+
+import dnscrypt
+import ed25519py
+
+RESPONSE_MAGIC = 'r6fnvWj8'
+
+TYPES = {'A': 1, 'CNAME': 5, 'TXT': 16, 'AAAA': 28}
+
+
+def encode_name(name):
+    return ''.join(chr(len(label)) + label for label in name.rstrip('.').split('.')) + '\x00'
+
+
+def encode_rdata(rtype, fields):
+    if rtype == 1:
+        return socket.inet_aton(fields[0])
+    if rtype == 28:
+        return socket.inet_pton(socket.AF_INET6, fields[0])
+    if rtype == 5:
+        return encode_name(fields[0])
+    if rtype == 16:
+        rdata = ''
+        for text in fields:
+            while True:
+                rdata += chr(len(text[:255])) + text[:255]
+                text = text[255:]
+                if not text:
+                    break
+        return rdata
+    raise ValueError("Unsupported record type %d" % rtype)
+
+
+def load_zone(path):
+    '''Read a zone file into {(name, type): [(ttl, rdata), ...]}.'''
+    with open(path) as f:
+        return parse_zone(f.read())
+
+
+def parse_zone(text):
+    zone = {}
+    for line in text.splitlines():
+        fields = shlex.split(line, comments=True)
+        if not fields:
+            continue
+        (name, ttl, rtype) = fields[:3]
+        rtype = TYPES[rtype.upper()]
+        key = (name.lower().rstrip('.'), rtype)
+        zone.setdefault(key, []).append((int(ttl), encode_rdata(rtype, fields[3:])))
+    return zone
+
+
+class DnscryptTestServer:
+    '''Serves one zone over DNSCrypt on a UDP socket.
+
+    A provider keypair, resolver keypair and certificate are generated when
+    none are given. provider_key is the hex-encoded provider public key that
+    clients pass to dnscrypt.query().'''
+
+    SOA_MINIMUM = 60
+    PADDING_BLOCK = 64  # responses are padded to a multiple of this, as resolvers do
+
+    def __init__(self, zone, ip='127.0.0.1', port=0, provider_name='2.dnscrypt-cert.localhost',
+                 provider_keypair=None, validity=86400, serial=1):
+        self.zone = zone
+        self.provider_name = provider_name.rstrip('.')
+        (self.provider_pk, provider_sk) = provider_keypair or ed25519py.crypto_sign_keypair()
+        self.provider_key = self.provider_pk.encode('hex')
+        (self.resolver_pk, self.resolver_sk) = dnscrypt.generate_keypair()
+        self.client_magic = self.resolver_pk[:8]
+        now = int(time.time())
+        signed = self.resolver_pk + self.client_magic + struct.pack('!III', serial, now - 60, now + validity)
+        self.bincert = 'DNSC\x00\x01\x00\x00' + ed25519py.crypto_sign(signed, provider_sk)
+
+        self.queries = 0
+        self.certificate_queries = 0
+        self._nmkeys = {}
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((ip, port))
+        (self.ip, self.port) = self._sock.getsockname()
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((self.ip, self.port))
+        self._listener.listen(64)
+        self._running = False
+
+    def start(self):
+        self._running = True
+        for target in (self.serve_forever, self.serve_tcp):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._sock.close()
+        self._listener.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            try:
+                (data, address) = self._sock.recvfrom(65535)
+            except socket.error:
+                continue
+            try:
+                response = self.handle(data)
+            except (dnscrypt.DnscryptException, struct.error, IndexError, ValueError):
+                continue  # drop what cannot be decrypted or parsed
+            self._sock.sendto(response, address)
+
+    def serve_tcp(self):
+        while self._running:
+            try:
+                (conn, address) = self._listener.accept()
+            except socket.error:
+                continue
+            thread = threading.Thread(target=self.serve_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve_connection(self, conn):
+        '''Answer length-prefixed queries on one connection, in order.'''
+        try:
+            while self._running:
+                data = dnscrypt.read_frame(conn)
+                conn.sendall(dnscrypt.frame(self.handle(data, tcp=True)))
+        except (dnscrypt.DnscryptException, socket.error, struct.error, IndexError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def handle(self, data, tcp=False):
+        '''Return the response to one query.'''
+        if data[:8] != self.client_magic:
+            self.certificate_queries += 1
+            return self.answer_certificate(data)
+        self.queries += 1
+
+        client_pk = data[8:40]
+        client_nonce = data[40:52]
+        nmkey = self._nmkeys.get(client_pk)
+        if nmkey is None:
+            nmkey = dnscrypt.create_nmkey(client_pk, self.resolver_sk)
+            self._nmkeys[client_pk] = nmkey
+        message = dnscrypt.decode_message(data[52:], client_nonce + 12 * '\x00', nmkey)
+        message = message[:message.rindex('\x80')]  # strip the ISO/IEC 7816-4 padding
+
+        server_nonce = os.urandom(12)
+        answer = self.answer(message)
+        if not tcp and len(answer) > self.payload_size(message):
+            answer = self.truncate(answer)
+        answer += '\x80' + '\x00' * (-(len(answer) + 1) % self.PADDING_BLOCK)
+        return (RESPONSE_MAGIC + client_nonce + server_nonce +
+                dnscrypt.backend.box_afternm(answer, client_nonce + server_nonce, nmkey))
+
+    def answer_certificate(self, message):
+        (question, question_end) = dnscrypt.DnsPacketConverter().readQuestion(message, 12)
+        if '.'.join(question.labels).lower() != self.provider_name or question.qtype != 16:
+            return self.response(message, question_end, 3, [])
+        return self.response(message, question_end, 0, [(16, 86400, encode_rdata(16, [self.bincert]))])
+
+    def answer(self, message):
+        (question, question_end) = dnscrypt.DnsPacketConverter().readQuestion(message, 12)
+        name = '.'.join(question.labels).lower()
+        records = self.zone.get((name, question.qtype))
+        if records:
+            return self.response(message, question_end, 0,
+                                 [(question.qtype, ttl, rdata) for (ttl, rdata) in records])
+        exists = any(key[0] == name for key in self.zone)
+        return self.response(message, question_end, 0 if exists else 3, [], negative=True)
+
+    def payload_size(self, message):
+        packet = dnscrypt.DnsPacketConverter().fromBinary(message)
+        for record in packet.additionalRecords:
+            if record.type == 41:  # OPT
+                return max(record.rrclass, 512)
+        return 512
+
+    def truncate(self, answer):
+        (question, question_end) = dnscrypt.DnsPacketConverter().readQuestion(answer, 12)
+        (qid, bits) = struct.unpack('!HH', answer[:4])
+        return struct.pack('!HHHHHH', qid, bits | 0x0200, 1, 0, 0, 0) + answer[12:question_end]
+
+    def response(self, message, question_end, rcode, records, negative=False):
+        (qid, bits) = struct.unpack('!HH', message[:4])
+        authority = []
+        if negative:
+            soa = encode_name('localhost') + encode_name('hostmaster.localhost') + \
+                  struct.pack('!IIIII', 1, 3600, 600, 86400, self.SOA_MINIMUM)
+            authority.append('\xc0\x0c' + struct.pack('!HHIH', 6, 1, self.SOA_MINIMUM, len(soa)) + soa)
+        answers = ['\xc0\x0c' + struct.pack('!HHIH', rtype, 1, ttl, len(rdata)) + rdata
+                   for (rtype, ttl, rdata) in records]
+        header = struct.pack('!HHHHHH', qid, 0x8180 | (bits & 0x0100) | rcode,
+                             1, len(answers), len(authority), 0)
+        return header + message[12:question_end] + ''.join(answers) + ''.join(authority)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve a zone file over DNSCrypt on loopback.')
+    parser.add_argument('zone')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5443)
+    parser.add_argument('--provider-name', default='2.dnscrypt-cert.localhost')
+    args = parser.parse_args()
+
+    server = DnscryptTestServer(load_zone(args.zone), args.ip, args.port, args.provider_name)
+    print 'Serving %s on %s:%d' % (args.zone, server.ip, server.port)
+    print 'Provider name %s, provider key %s' % (server.provider_name, server.provider_key)
+    server.serve_forever()